@@ -0,0 +1,177 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import threading
+import collections
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+import dib
+
+class FakeDocker:
+    '''
+    Stands in for LocalDocker: counts docker calls and sleeps to simulate
+    their latency
+    '''
+    def __init__(self, latency=0.0, host="local"):
+        self.latency = latency
+        self.host = host
+        self.prefix = ""
+        self.images = set()
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def call(self, command):
+        with self.lock:
+            self.calls[command] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def cache_images(self):
+        self.call("images")
+
+    def build_image(self, name, version, context, log=None, cache_from=[], inline_cache=False):
+        self.call("build")
+        with self.lock:
+            self.images.add((name, version))
+
+    def push_image(self, name, version, log=None):
+        self.call("push")
+
+    def image_digests(self, name, version):
+        return []
+
+    def cached_image(self, name, version):
+        return (name, version) in self.images
+
+class FakeRegistry:
+    '''
+    Stands in for Registry: has no manifest of any image
+    '''
+    def manifest_digest(self, repository, tag):
+        return None
+
+def generate_catalogue(image_dir, packages, depth, versions, files):
+    '''
+    Writes packages image definitions as chains of depth levels, every
+    package has versions versions mapped to the same version of its parent
+    '''
+    os.makedirs(image_dir)
+    with open(os.path.join(image_dir, "macros.j2"), "w") as f:
+        f.write("{% set prefix = 'localhost:5000/bench/' %}\n")
+
+    width = max(1, packages / depth)
+    version_names = ["v%i" % j for j in range(versions)]
+    for i in range(packages):
+        package_dir = os.path.join(image_dir, "level%i" % (i / width), "pkg%i" % i)
+        os.makedirs(package_dir)
+        if i < width:
+            parents = "scratch"
+            mappings = ','.join(["[%i]:[0]:latest" % j for j in range(versions)])
+        else:
+            parents = "{{g.prefix}}pkg%i" % (i - width)
+            mappings = ','.join(["[%i]:[0]:%s" % (j, version_names[j]) for j in range(versions)])
+        with open(os.path.join(package_dir, "package.j2"), "w") as f:
+            f.write("{% import 'macros.j2' as g -%}\n")
+            f.write("name={{g.prefix}}pkg%i\n" % i)
+            f.write("versions=%s\n" % ','.join(version_names))
+            f.write("type=class\n")
+            f.write("parents=%s\n" % parents)
+            f.write("mappings=%s\n" % mappings)
+        with open(os.path.join(package_dir, "Dockerfile.j2"), "w") as f:
+            f.write("FROM {{parent}}:{{parent_version}}\n")
+            for j in range(files):
+                f.write("ADD file%i.txt /opt/pkg%i/\n" % (j, i))
+            f.write("RUN echo {{name}} {{version}}\n")
+        for j in range(files):
+            with open(os.path.join(package_dir, "file%i.txt" % j), "w") as f:
+                f.write("pkg%i file%i\n" % (i, j) * 64)
+
+def peak_memory():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def run(dockers, parsed):
+    '''
+    Runs the build or push pipeline once on a farm of the fake dockers,
+    returns (phase, seconds, peak memory MB, docker calls) tuples
+    '''
+    dib.Project.logger = dib.Logger()
+    dib.Project.env = Environment(loader=FileSystemLoader('images'),
+        bytecode_cache=FileSystemBytecodeCache(dib.Project.template_cache_dir))
+    project = dib.Project()
+    project.docker = dib.DockerFarm(dockers)
+    project.registries["localhost:5000"] = FakeRegistry()
+
+    plan = argparse.Namespace(action=parsed.action, name=None, version=None, parents=False,
+        force=False, jobs=parsed.jobs, push_jobs=parsed.push_jobs, push_retries=0,
+        context=parsed.context, backend="cli", socket=None, docker_host=None,
+        changed_since=None, changed=None, trace=None)
+    phases = [("load", project.load_image_definition),
+        ("plan", lambda: project.make_plan(plan)),
+        ("generate", project.generate_dockerfiles)]
+    if parsed.action == "push":
+        phases.append(("build+push", project.build_and_push_images))
+    else:
+        phases.append(("build", project.build_images))
+
+    report = []
+    stdout = sys.stdout
+    for phase, action in phases:
+        for docker in dockers:
+            docker.calls.clear()
+        sys.stdout = open(os.devnull, "w")
+        try:
+            begin = time.time()
+            action()
+            seconds = time.time() - begin
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        calls = sum([docker.calls for docker in dockers], collections.Counter())
+        calls = ', '.join(["%s %i" % c for c in sorted(calls.items())])
+        report.append((phase, seconds, peak_memory(), calls))
+    return report
+
+if __name__ == "__main__":
+    """
+    python bench.py [options]
+    Generates a synthetic image catalogue in a temporary directory and runs
+    dib's pipeline on it against a fake docker, cold and then warm.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packages', type=int, default=1000, help='number of image definitions')
+    parser.add_argument('--depth', type=int, default=10, help='length of parent chains')
+    parser.add_argument('--versions', type=int, default=3, help='versions per image')
+    parser.add_argument('--files', type=int, default=1, help='support files per image')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every fake docker call takes')
+    parser.add_argument('--action', choices=['build', 'push'], default='build', help='pipeline to run')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of images to build in parallel')
+    parser.add_argument('--push-jobs', type=int, default=1, help='number of images to push in parallel')
+    parser.add_argument('--context', choices=['copy', 'link', 'tar'], default='copy', help='build context mode')
+    parser.add_argument('--hosts', type=int, default=1, help='number of fake docker hosts to spread builds over')
+    parser.add_argument('--runs', type=int, default=2, help='number of runs on the same catalogue')
+    parsed = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="dib-bench-")
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        begin = time.time()
+        generate_catalogue(os.path.abspath(dib.Project.image_dir), parsed.packages, parsed.depth, parsed.versions, parsed.files)
+        print "Generated %i images with %i versions each in %.2fs" % (parsed.packages, parsed.versions, time.time() - begin)
+
+        dockers = [FakeDocker(parsed.latency, "host%i" % i) for i in range(parsed.hosts)]
+        for i in range(parsed.runs):
+            print "Run %i" % (i + 1)
+            print "  %-10s %10s %12s  %s" % ("phase", "seconds", "peak MB", "docker calls")
+            for phase, seconds, memory, calls in run(dockers, parsed):
+                print "  %-10s %10.3f %12.1f  %s" % (phase, seconds, memory, calls)
+            if parsed.hosts > 1:
+                print "  images per host: %s" % ', '.join(["%s %i" % (d.host, len(d.images)) for d in dockers])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
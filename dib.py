@@ -2,11 +2,30 @@ import os
 import sys
 import re
 import io
+import json
+import time
 import shutil
+import base64
+import ctypes
+import ctypes.util
+import select
+import socket
+import struct
+import urllib
+import hashlib
+import httplib
+import functools
+import sqlite3
+import tarfile
+import filecmp
+import itertools
+import collections
 import argparse
+import threading
 import subprocess
+import Queue
 from subprocess import CalledProcessError
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, TemplateError
 
 class Logger():
     W  = '\033[0m'  # white (normal)
@@ -15,21 +34,31 @@ class Logger():
     O  = '\033[33m' # orange
     B  = '\033[34m' # blue
     P  = '\033[35m' # purple
+    # held while writing a line, so that lines of concurrent builds do not mix
+    stdout_lock = threading.Lock()
 
     def __init__(self):
         self.summary_list = {}
+        self.time_list = []
+
+    @staticmethod
+    def write(line):
+        # print writes the text and the newline apart, one write keeps them together
+        with Logger.stdout_lock:
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
 
     def info(self, message):
-        print(("{}INFO{} %s" % message).format(Logger.B, Logger.W))
+        Logger.write("%sINFO%s %s" % (Logger.B, Logger.W, message))
 
     def debug(self, message):
-        print(("{}DEBUG{} %s" % message).format(Logger.P, Logger.W))
+        Logger.write("%sDEBUG%s %s" % (Logger.P, Logger.W, message))
 
     def warn(self, message):
-        print(("{}WARN{} %s" % message).format(Logger.O, Logger.W))
+        Logger.write("%sWARN%s %s" % (Logger.O, Logger.W, message))
 
     def error(self, message):
-        print(("{}ERROR{} %s" % message).format(Logger.R, Logger.W))
+        Logger.write("%sERROR%s %s" % (Logger.R, Logger.W, message))
 
     def summary_ok(self, phase, message):
         if not self.summary_list.has_key(phase):
@@ -46,9 +75,78 @@ class Logger():
             if self.summary_list.has_key(phase):
                 for s in self.summary_list[phase]:
                     if s[0] == "OK":
-                        print ("{}%s %s{}" % (s[0], s[1])).format(Logger.G, Logger.W)
+                        Logger.write("%s%s %s%s" % (Logger.G, s[0], s[1], Logger.W))
                     else:
-                        print ("{}%s %s - %s{}" % (s[0], s[1], s[2])).format(Logger.R, Logger.W)
+                        Logger.write("%s%s %s - %s%s" % (Logger.R, s[0], s[1], s[2], Logger.W))
+        if len(self.time_list) > 0:
+            times = ', '.join(map(lambda t: "%s %.2fs" % t, self.time_list))
+            Logger.write("%sTime %s%s" % (Logger.B, times, Logger.W))
+
+    def summary_time(self, phase, seconds):
+        self.time_list.append((phase, seconds))
+
+    def reset(self):
+        self.summary_list = {}
+        self.time_list = []
+
+class Tracer:
+    '''
+    Records the time spent in phases and per-image steps, which can be
+    written as a Chrome trace event file
+    '''
+    def __init__(self):
+        self.start = time.time()
+        self.events = []
+        self.durations = {}
+        self.threads = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, category, begin, end, key=None):
+        with self.lock:
+            thread = threading.current_thread()
+            if not self.threads.has_key(thread.ident):
+                self.threads[thread.ident] = (len(self.threads), thread.name)
+            self.events.append({"name": name, "cat": category, "ph": "X",
+                "ts": int((begin - self.start) * 1000000), "dur": int((end - begin) * 1000000),
+                "pid": os.getpid(), "tid": self.threads[thread.ident][0]})
+            self.durations[(category, key)] = end - begin
+
+    def duration(self, category, key=None):
+        return self.durations.get((category, key))
+
+    def write(self, path):
+        events = list(self.events)
+        for tid, thread_name in self.threads.values():
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                "args": {"name": thread_name}})
+        with io.open(path, "wb") as f:
+            f.write(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+
+def traced(category, per_image=False, summary=True):
+    '''
+    Records the calls of a Project method in the project's tracer. Per-image
+    methods take the image and version as their first arguments, the time of
+    other methods is also reported in the summary unless summary is False,
+    as for steps that run within a phase already timed.
+    '''
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            begin = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                end = time.time()
+                if per_image:
+                    key = (args[0].name, args[1])
+                    self.tracer.record("%s %s:%s" % (category, key[0], key[1]), category, begin, end, key)
+                else:
+                    self.tracer.record(category, category, begin, end)
+                    if summary:
+                        self.logger.summary_time(category, end - begin)
+        return wrapper
+    return decorate
+
 class Image():
     logger = Logger()
     name_string = "[A-Za-z0-9/:._-]+"
@@ -66,7 +164,10 @@ class Image():
     mapping_string = "(%s):(%s):%s" % (version_or_index_string, name_or_index_string, version_string)
     mappings_string = "%s(,%s)*" % (mapping_string, mapping_string)
     mappings_pattern = re.compile("^%s$" % mappings_string)
-    def __init__(self, definition, template=None, files=[]):
+    def __init__(self, definition, template=None, files=[], fields=None):
+        '''
+        Parses definition, or restores the fields of a parsed definition
+        '''
         self.name = None
         self.type = None
         self.parents = []
@@ -75,25 +176,13 @@ class Image():
         self.mappings = {}
         self.template = template
         self.files = files
+        self.path = None
 
-        mappings_value = None
-        for line in definition.splitlines():
-            tokens = line.split('=')
-            if len(tokens) > 1:
-                key = tokens[0].strip()
-                value = tokens[1].strip()
-                # print "key=%s value=%s" % (key, value)
-                if key == "name" and Image.name_pattern.match(value):
-                    self.name = value
-                elif key == "type" and Image.type_pattern.match(value):
-                    self.type = value
-                elif key == "parents" and Image.parents_pattern.match(value):
-                    self.parents = value.split(',')
-                    self.parent_images = map(lambda x: None, self.parents)
-                elif key == "versions" and Image.versions_pattern.match(value):
-                    self.versions = value.split(',')
-                elif key == "mappings" and Image.mappings_pattern.match(value):
-                    mappings_value = value
+        if fields != None:
+            self.restore(fields)
+            mappings_value = None
+        else:
+            mappings_value = self.parse(definition)
 
         # print "self.name %s" % self.name
         # print "self.type %s" % self.type
@@ -122,6 +211,45 @@ class Image():
                 #except:
                     #e = sys.exc_info()[0]
                     self.logger.warn("Ignored %s's mapping %s due to %s" % (self.name, mappings_value, e))
+
+    def parse(self, definition):
+        '''
+        Returns the raw value of mappings, which can only be resolved
+        after versions and parents are known
+        '''
+        mappings_value = None
+        for line in definition.splitlines():
+            tokens = line.split('=')
+            if len(tokens) > 1:
+                key = tokens[0].strip()
+                value = tokens[1].strip()
+                # print "key=%s value=%s" % (key, value)
+                if key == "name" and Image.name_pattern.match(value):
+                    self.name = value
+                elif key == "type" and Image.type_pattern.match(value):
+                    self.type = value
+                elif key == "parents" and Image.parents_pattern.match(value):
+                    self.parents = value.split(',')
+                    self.parent_images = map(lambda x: None, self.parents)
+                elif key == "versions" and Image.versions_pattern.match(value):
+                    self.versions = value.split(',')
+                elif key == "mappings" and Image.mappings_pattern.match(value):
+                    mappings_value = value
+        return mappings_value
+
+    def fields(self):
+        return {"name": self.name, "type": self.type, "parents": self.parents,
+            "versions": self.versions, "mappings": self.mappings}
+
+    def restore(self, fields):
+        self.name = fields["name"]
+        self.type = fields["type"]
+        self.parents = fields["parents"]
+        self.parent_images = map(lambda x: None, self.parents)
+        self.versions = fields["versions"]
+        for version, parent in fields["mappings"].items():
+            self.mappings[version] = tuple(parent)
+
     def member_of(self, member, list):
         '''
         May raise ValueError, IndexError
@@ -130,7 +258,7 @@ class Image():
             index = int(member[1:-1])
             return list[index]
         else:
-            if len(filter(lambda x: x==member, list)) > 0:
+            if member in list:
                 return member
             else:
                 raise ValueError("%s not found" % member)
@@ -142,16 +270,296 @@ class Image():
     def __repr__(self):
         return self.__str__()
 
-class LocalDocker:
-    header_pattern = re.compile("^REPOSITORY\s+TAG\s+IMAGE ID\s+CREATED\s+SIZE$")
+class LazyTemplate:
+    '''
+    Jinja template that is only loaded and compiled when first rendered
+    '''
+    def __init__(self, env, path):
+        self.env = env
+        self.path = path
+        self.template = None
+
+    def render(self, *args, **kwargs):
+        if self.template == None:
+            self.template = self.env.get_template(self.path)
+        return self.template.render(*args, **kwargs)
+
+    def reset(self):
+        '''
+        Reloads the template on next render, e.g. after its file changed
+        '''
+        self.template = None
+
+class ImageGraph:
+    '''
+    Index of image definitions: images by name, and (name, version) nodes
+    with edges to their mapped parent version and back to their children
+    '''
+    logger = Logger()
+
     def __init__(self):
-        self.images = []
+        self.names = []
+        self.images = {}
+        self.paths = {}
+        self.nodes = {}
+        self.parent = {}
+        self.children = {}
+        self.order = []
+
+    def add(self, image):
+        if self.images.has_key(image.name):
+            raise RuntimeError("duplicated image name")
+        self.names.append(image.name)
+        self.images[image.name] = image
+        self.paths[image.path] = image.name
+
+    def link(self):
+        '''
+        Resolves parent images and version edges, computes a topological
+        order of nodes and drops nodes that are in or below a circular
+        dependency
+        '''
+        self.nodes = {}
+        self.parent = {}
+        self.children = {}
+        keys = []
+        for n in self.names:
+            c = self.images[n]
+            c.parent_images = map(lambda p: self.images.get(p), c.parents)
+            for v in c.versions:
+                key = (c.name, v)
+                keys.append(key)
+                self.nodes[key] = (c, v)
+                self.children[key] = []
 
-    def image_of(self, name, version):
-        return type('',(object,),{'name':name,'version':version})()
+        for key in keys:
+            c, v = self.nodes[key]
+            parent = None
+            if c.mappings.has_key(v) and self.nodes.has_key(c.mappings[v]):
+                parent = c.mappings[v]
+                self.children[parent].append(key)
+            self.parent[key] = parent
 
-    def execute(self, command, quiet=False):
-        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.order = []
+        ready = collections.deque(filter(lambda k: self.parent[k] == None, keys))
+        while len(ready) > 0:
+            key = ready.popleft()
+            self.order.append(key)
+            ready.extend(self.children[key])
+
+        if len(self.order) < len(keys):
+            ordered = set(self.order)
+            for key in keys:
+                if not key in ordered:
+                    self.logger.warn("Ignored %s:%s due to circular dependency" % key)
+                    del self.nodes[key]
+                    del self.parent[key]
+                    del self.children[key]
+            for key in self.order:
+                self.children[key] = filter(lambda k: k in ordered, self.children[key])
+
+    def descendants(self, key):
+        '''
+        Returns all nodes built on top of key
+        '''
+        found = []
+        stack = [key]
+        while len(stack) > 0:
+            children = self.children[stack.pop()]
+            found.extend(children)
+            stack.extend(children)
+        return found
+
+class BuildContext:
+    '''
+    Build context of an image version: its generated directory, plus
+    support files added straight from the images directory, given as
+    (source, arcname) pairs
+    '''
+    def __init__(self, path, files=[]):
+        self.path = path
+        self.files = files
+
+    def write_tar(self, fileobj):
+        tar = tarfile.open(fileobj=fileobj, mode="w|")
+        tar.add(self.path, arcname=".")
+        for source, arcname in self.files:
+            tar.add(source, arcname=arcname)
+        tar.close()
+
+class Stage:
+    '''
+    Rewrites the rendered Dockerfile of an image version as a stage of a
+    flattened multi-stage Dockerfile: the stage is named name, FROM parent
+    becomes FROM previous, the stage before, and ADD/COPY sources are
+    looked up in the build context directory named after the stage
+    '''
+    flags_pattern = re.compile("^((?:--\S+\s+)*)(.*)$", re.S)
+
+    def __init__(self, name, parent, previous=None):
+        self.name = name
+        self.parent = parent
+        self.previous = previous
+
+    @staticmethod
+    def instructions(text):
+        '''
+        Splits a Dockerfile into (instruction, text) pairs, where an
+        instruction continued over several lines is joined into one line and
+        text keeps its original lines
+        '''
+        pairs = []
+        joined = None
+        lines = []
+        for line in text.splitlines():
+            lines.append(line)
+            part = line if joined == None else line.lstrip()
+            if part.rstrip().endswith("\\") and not line.lstrip().startswith("#"):
+                joined = (joined or "") + part.rstrip()[:-1].rstrip() + " "
+                continue
+            pairs.append(((joined or "") + part, "\n".join(lines)))
+            joined = None
+            lines = []
+        if joined != None:
+            pairs.append((joined.rstrip(), "\n".join(lines)))
+        return pairs
+
+    def rewrite(self, rendered):
+        lines = []
+        froms = 0
+        for instruction, text in Stage.instructions(rendered):
+            tokens = instruction.split(None, 1)
+            keyword = tokens[0].upper() if len(tokens) > 1 else None
+            if keyword == "FROM":
+                froms += 1
+                if froms > 1:
+                    raise RuntimeError("Dockerfile of stage %s is multi-stage already" % self.name)
+                text = self.rewrite_from(tokens[1])
+            elif keyword in ["ADD", "COPY"]:
+                text = "%s %s" % (tokens[0], self.relocate(tokens[1]))
+            lines.append(text)
+        if froms == 0:
+            raise RuntimeError("Dockerfile of stage %s has no FROM" % self.name)
+        return "\n".join(lines) + "\n"
+
+    def rewrite_from(self, arguments):
+        flags, rest = Stage.flags_pattern.match(arguments).groups()
+        # drops the alias the image may have given its only stage
+        image = rest.split()[0]
+        if self.previous != None and image == self.parent:
+            image = self.previous
+        return "FROM %s%s AS %s" % (flags, image, self.name)
+
+    def relocate(self, arguments):
+        flags, rest = Stage.flags_pattern.match(arguments).groups()
+        if "--from=" in flags:
+            # copies from another image or stage, not from the context
+            return arguments
+        if rest.startswith("["):
+            try:
+                paths = json.loads(rest)
+            except ValueError:
+                return arguments
+            return flags + json.dumps(map(self.source, paths[:-1]) + paths[-1:])
+        paths = rest.split()
+        return flags + " ".join(map(self.source, paths[:-1]) + paths[-1:])
+
+    def source(self, path):
+        if "://" in path or path.startswith("git@") or path.startswith("<<"):
+            return path
+        return self.name + "/" + path.lstrip("/")
+
+class BuildLog:
+    '''
+    Output of one image's docker command: written to a log file and to
+    stdout prefixed with the image, only a bounded tail is kept in memory
+    for error reports
+    '''
+    tail_size = 20
+    # classic builder and BuildKit plain progress output
+    step_pattern = re.compile("^Step \d+(/\d+)? : (\S+)")
+    buildkit_step_pattern = re.compile("^#(\d+) \[[^\]]*\d+/\d+\] (\S+)")
+    buildkit_cached_pattern = re.compile("^#(\d+) CACHED\s*$")
+
+    def __init__(self, path, label):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass # created by another build meanwhile
+        self.path = path
+        self.label = label
+        self.file = io.open(path, "wb")
+        self.tail = collections.deque(maxlen=BuildLog.tail_size)
+        self.partial = ""
+        # build steps, FROM aside, and how many of them were cached
+        self.steps = 0
+        self.cached = 0
+        self.buildkit_steps = set()
+
+    def write(self, data):
+        self.file.write(data)
+        lines = (self.partial + data).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.line(line)
+
+    def line(self, line):
+        self.tail.append(line)
+        step = BuildLog.step_pattern.match(line)
+        buildkit_step = BuildLog.buildkit_step_pattern.match(line)
+        buildkit_cached = BuildLog.buildkit_cached_pattern.match(line)
+        if step != None and step.group(2).upper() != "FROM":
+            self.steps += 1
+        elif line.strip() == "---> Using cache":
+            self.cached += 1
+        elif buildkit_step != None and buildkit_step.group(2).upper() != "FROM" and \
+            not buildkit_step.group(1) in self.buildkit_steps:
+            # BuildKit may repeat a step's header while it runs
+            self.buildkit_steps.add(buildkit_step.group(1))
+            self.steps += 1
+        elif buildkit_cached != None and buildkit_cached.group(1) in self.buildkit_steps:
+            self.cached += 1
+        Logger.write("[%s] %s" % (self.label, line))
+
+    def close(self):
+        if self.partial != "":
+            self.line(self.partial)
+            self.partial = ""
+        self.file.close()
+
+    def report(self):
+        return "last %i lines of %s:\n%s" % (len(self.tail), self.path, "\n".join(self.tail))
+
+class LocalDocker:
+    def __init__(self, host=None):
+        '''
+        host is the daemon to connect to as accepted by docker -H, the
+        CLI's default daemon if None
+        '''
+        self.host = host or "local"
+        self.command = "docker" if host == None else "docker -H %s" % host
+        self.prefix = ""
+        self.images = set()
+
+    def execute(self, command, quiet=False, write_input=None, log=None):
+        '''
+        Returns the output lines of command, unless they are streamed to
+        log. write_input, if given, is called in another thread with the
+        command's stdin, which is closed afterwards
+        '''
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            stdin=subprocess.PIPE if write_input != None else None)
+        if write_input != None:
+            def feed():
+                try:
+                    write_input(process.stdin)
+                except IOError:
+                    pass # command exited early, its exit code tells why
+                finally:
+                    process.stdin.close()
+            threading.Thread(target=feed).start()
 
         lines = []
         # Poll process for new output until finished
@@ -159,6 +567,9 @@ class LocalDocker:
             nextline = process.stdout.readline()
             if nextline == '' and process.poll() is not None:
                 break
+            if log != None:
+                log.write(nextline)
+                continue
             if not quiet:
                 sys.stdout.write(nextline)
                 sys.stdout.flush()
@@ -172,51 +583,773 @@ class LocalDocker:
             raise RuntimeError("Command %s returns %i %s" % (command, exitCode, process.communicate()[0]))
 
     def cache_images(self):
+        '''
+        Lists the repository and tag of the images under the prefix only
+        '''
+        command = "%s images --format '{{.Repository}}\t{{.Tag}}'" % self.command
+        if self.prefix != "":
+            command += " --filter 'reference=%s*'" % self.prefix
         try:
-            output_images = self.execute('docker images', True)
+            output_images = self.execute(command, True)
         except CalledProcessError as e:
             raise RuntimeError(e)
-        if len(output_images) == 0:
-            raise RuntimeError("No output when cache images %s" % output_images)
-        if not LocalDocker.header_pattern.match(output_images[0]):
-            raise RuntimeError("Bad output when cache images %s " % output_images)
-
-        for line in output_images[1:]:
-            tokens = re.compile("\s+").split(line)
-            if len(tokens) > 2:
-                image = self.image_of(tokens[0], tokens[1])
-                self.images.append(image)
-
-    def build_image(self, name, version, path):
+
+        for line in output_images:
+            tokens = line.rstrip("\n").split("\t")
+            if len(tokens) == 2 and tokens[1] != "<none>":
+                self.images.add((tokens[0], tokens[1]))
+
+    def build_image(self, name, version, context, log=None, cache_from=[], inline_cache=False):
+        '''
+        inline_cache has BuildKit write cache metadata into the image, so
+        that it can be a cache source once saved or pushed
+        '''
+        options = ''.join(map(lambda tag: " --cache-from %s" % tag, cache_from))
+        if inline_cache:
+            options += " --build-arg BUILDKIT_INLINE_CACHE=1"
         try:
-            output_build = self.execute("docker build -t %s:%s %s" % (name, version, path))
+            if len(context.files) == 0:
+                output_build = self.execute("%s build%s -t %s:%s %s" % (self.command, options, name, version, context.path), log=log)
+            else:
+                output_build = self.execute("%s build%s -t %s:%s -" % (self.command, options, name, version), write_input=context.write_tar, log=log)
         except CalledProcessError as e:
             raise RuntimeError(e)
         #print output_build
-        image = self.image_of(name, version)
-        self.images.append(image)
+        self.images.add((name, version))
 
-    def push_image(self, name, version):
+    def pull_image(self, name, version, log=None):
         try:
-            output_push = subprocess.check_output("docker push %s:%s" % (name, version))
+            self.execute("%s pull %s:%s" % (self.command, name, version), log=log)
         except CalledProcessError as e:
             raise RuntimeError(e)
+        self.images.add((name, version))
+
+    def load_image(self, name, version, path, log=None):
+        try:
+            self.execute("%s load -i %s" % (self.command, path), log=log)
+        except CalledProcessError as e:
+            raise RuntimeError(e)
+        self.images.add((name, version))
+
+    def save_image(self, name, version, path, log=None):
+        try:
+            self.execute("%s save -o %s %s:%s" % (self.command, path, name, version), log=log)
+        except CalledProcessError as e:
+            raise RuntimeError(e)
+
+    def push_image(self, name, version, log=None):
+        try:
+            output_push = self.execute("%s push %s:%s" % (self.command, name, version), log=log)
+        except CalledProcessError as e:
+            raise RuntimeError(e)
+
+    def image_digests(self, name, version):
+        '''
+        Returns the repository digests of the pushed or pulled manifests of
+        a local image
+        '''
+        output = self.execute("%s inspect --format '{{json .RepoDigests}}' %s:%s" % (self.command, name, version), True)
+        return json.loads(''.join(output)) or []
 
     def cached_image(self, name, version):
-        for i in self.images:
-            if i.name == name and i.version == version:
-                return True
-        return False
+        return (name, version) in self.images
+
+class Registry:
+    '''
+    Client of a registry's v2 API, tells the digest of the manifest the
+    registry has for an image tag
+    '''
+    manifest_types = ["application/vnd.docker.distribution.manifest.v2+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.oci.image.index.v1+json"]
+    default_host = "registry-1.docker.io"
+
+    def __init__(self, host):
+        self.host = host
+        # like docker, registries on the local host are insecure
+        if host.startswith("localhost") or host.startswith("127."):
+            self.connection_class = httplib.HTTPConnection
+        else:
+            self.connection_class = httplib.HTTPSConnection
+
+    @staticmethod
+    def split(name):
+        '''
+        Splits an image name into its registry host and repository
+        '''
+        parts = name.split('/', 1)
+        if len(parts) > 1 and ('.' in parts[0] or ':' in parts[0] or parts[0] == "localhost"):
+            return parts[0], parts[1]
+        if len(parts) == 1:
+            return Registry.default_host, "library/" + name
+        return Registry.default_host, name
+
+    def manifest_digest(self, repository, tag):
+        '''
+        Returns None if the registry has no manifest for repository:tag
+        '''
+        connection = self.connection_class(self.host, timeout=30)
+        try:
+            connection.request("HEAD", "/v2/%s/manifests/%s" % (repository, tag),
+                headers={"Accept": ", ".join(Registry.manifest_types)})
+            response = connection.getresponse()
+            response.read()
+        except (socket.error, httplib.HTTPException) as e:
+            raise RuntimeError("Registry %s request failed: %s" % (self.host, e))
+        finally:
+            connection.close()
+        if response.status == 404:
+            return None
+        if response.status != 200:
+            raise RuntimeError("Registry %s returns %i for %s:%s" % (self.host, response.status, repository, tag))
+        return response.getheader("Docker-Content-Digest")
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, socket_path):
+        httplib.HTTPConnection.__init__(self, "localhost")
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+class ChunkedWriter:
+    '''
+    File object sending its writes as chunks of a chunked HTTP request body
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+
+    def write(self, data):
+        if len(data) > 0:
+            self.connection.send("%x\r\n%s\r\n" % (len(data), data))
+
+class DockerEngine:
+    '''
+    Talks to the Docker Engine API on a unix socket or a tcp address
+    instead of running the docker CLI
+    '''
+    api_version = "v1.25"
+
+    def __init__(self, host="/var/run/docker.sock"):
+        '''
+        host is either unix://<path>, tcp://<host>:<port> or a socket path
+        '''
+        self.host = host
+        if host.startswith("tcp://"):
+            self.address = host[len("tcp://"):]
+            self.socket_path = None
+        elif host.startswith("unix://"):
+            self.socket_path = host[len("unix://"):]
+        else:
+            self.socket_path = host
+        self.prefix = ""
+        self.images = set()
+
+    def request(self, method, url, body=None, headers={}, write_body=None):
+        '''
+        write_body, if given, is called with a file object whose writes are
+        sent as a chunked request body
+        '''
+        if self.socket_path != None:
+            connection = UnixHTTPConnection(self.socket_path)
+        else:
+            connection = httplib.HTTPConnection(self.address)
+        try:
+            if write_body == None:
+                connection.request(method, "/%s%s" % (DockerEngine.api_version, url), body, headers)
+            else:
+                connection.putrequest(method, "/%s%s" % (DockerEngine.api_version, url))
+                for k, v in headers.items():
+                    connection.putheader(k, v)
+                connection.putheader("Transfer-Encoding", "chunked")
+                connection.endheaders()
+                write_body(ChunkedWriter(connection))
+                connection.send("0\r\n\r\n")
+            response = connection.getresponse()
+        except (socket.error, httplib.HTTPException) as e:
+            raise RuntimeError("Docker engine request %s %s failed: %s" % (method, url, e))
+        if response.status != 200:
+            raise RuntimeError("Docker engine request %s %s returns %i %s" % (method, url, response.status, response.read()))
+        return response
+
+    def chunks(self, response):
+        '''
+        Yields the body of response as it arrives, chunk by chunk
+        '''
+        if not response.chunked:
+            yield response.read()
+            return
+        # HTTPResponse.read(amt) blocks until amt bytes arrived, so the
+        # chunked encoding is read directly from the socket file
+        while True:
+            size = int(response.fp.readline().split(';')[0], 16)
+            if size == 0:
+                break
+            chunk = response.fp.read(size)
+            response.fp.readline()
+            yield chunk
+        response.close()
+
+    def stream(self, response, log=None):
+        '''
+        Reads a JSON progress stream to log or stdout, raises RuntimeError
+        on an error message
+        '''
+        remaining = ""
+        for chunk in self.chunks(response):
+            lines = (remaining + chunk).split("\n")
+            remaining = lines.pop()
+            for line in lines:
+                self.message(line, log)
+        self.message(remaining, log)
+
+    def message(self, line, log):
+        if line.strip() == "":
+            return
+        message = json.loads(line)
+        if message.has_key("error"):
+            raise RuntimeError(message["error"])
+        if message.has_key("stream"):
+            text = message["stream"].encode('utf8')
+        elif message.has_key("status"):
+            text = ("%s %s\n" % (message.get("id", ""), message["status"])).encode('utf8')
+        else:
+            return
+        if log != None:
+            log.write(text)
+        else:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+
+    def cache_images(self):
+        url = "/images/json"
+        if self.prefix != "":
+            url += "?filters=" + urllib.quote(json.dumps({"reference": [self.prefix + "*"]}))
+        for image in json.loads(self.request("GET", url).read()):
+            for tag in image.get("RepoTags") or []:
+                tokens = tag.rsplit(':', 1)
+                if len(tokens) > 1 and tag != "<none>:<none>":
+                    self.images.add((tokens[0], tokens[1]))
+
+    def build_image(self, name, version, context, log=None, cache_from=[], inline_cache=False):
+        query = {"t": "%s:%s" % (name, version)}
+        if len(cache_from) > 0:
+            query["cachefrom"] = json.dumps(cache_from)
+        if inline_cache:
+            query["buildargs"] = json.dumps({"BUILDKIT_INLINE_CACHE": "1"})
+        response = self.request("POST", "/build?" + urllib.urlencode(query),
+            headers={"Content-Type": "application/x-tar"}, write_body=context.write_tar)
+        self.stream(response, log)
+        self.images.add((name, version))
+
+    def pull_image(self, name, version, log=None):
+        response = self.request("POST", "/images/create?" + urllib.urlencode({"fromImage": name, "tag": version}))
+        self.stream(response, log)
+        self.images.add((name, version))
+
+    def load_image(self, name, version, path, log=None):
+        def write_body(writer):
+            with io.open(path, "rb") as f:
+                for block in iter(lambda: f.read(65536), b''):
+                    writer.write(block)
+        response = self.request("POST", "/images/load", headers={"Content-Type": "application/x-tar"},
+            write_body=write_body)
+        self.stream(response, log)
+        self.images.add((name, version))
+
+    def save_image(self, name, version, path, log=None):
+        response = self.request("GET", "/images/get?" + urllib.urlencode({"names": "%s:%s" % (name, version)}))
+        with io.open(path, "wb") as f:
+            for chunk in self.chunks(response):
+                f.write(chunk)
+
+    def push_image(self, name, version, log=None):
+        # the engine requires an auth header even for anonymous registries
+        auth = base64.b64encode("{}")
+        response = self.request("POST", "/images/%s/push?%s" % (urllib.quote(name, safe="/:"), urllib.urlencode({"tag": version})),
+            None, {"X-Registry-Auth": auth})
+        self.stream(response, log)
+
+    def image_digests(self, name, version):
+        '''
+        Returns the repository digests of the pushed or pulled manifests of
+        a local image
+        '''
+        response = self.request("GET", "/images/%s/json" % urllib.quote("%s:%s" % (name, version), safe="/:"))
+        return json.loads(response.read()).get("RepoDigests") or []
+
+    def cached_image(self, name, version):
+        return (name, version) in self.images
+
+class BuildCache:
+    '''
+    Warms the layer cache of a docker host before a build and keeps built
+    images for later runs: cache source images are loaded from the cache
+    directory, or pulled from their registry if pull, and built images are
+    saved to the cache directory
+    '''
+    def __init__(self, pull=False, directory=None):
+        self.pull = pull
+        self.directory = directory
+        if directory != None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, name, version):
+        return os.path.join(self.directory, re.sub("[^A-Za-z0-9_.-]", "_", "%s:%s" % (name, version)) + ".tar")
+
+    def restore(self, backend, sources, log=None):
+        '''
+        Makes the (name, version) sources available on backend as far as
+        possible, returns the tags of the available ones
+        '''
+        tags = []
+        for name, version in sources:
+            tag = "%s:%s" % (name, version)
+            try:
+                if backend.cached_image(name, version):
+                    pass
+                elif self.directory != None and os.path.isfile(self.path(name, version)):
+                    backend.load_image(name, version, self.path(name, version), log)
+                elif self.pull:
+                    backend.pull_image(name, version, log)
+                else:
+                    continue
+                tags.append(tag)
+            except RuntimeError as e:
+                if log != None:
+                    log.write("cache source %s not available: %s\n" % (tag, e))
+        return tags
+
+    def store(self, backend, name, version, log=None):
+        '''
+        Saves name:version to the cache directory, a failed export only
+        leaves the image out of the cache
+        '''
+        if self.directory == None:
+            return
+        path = self.path(name, version)
+        try:
+            backend.save_image(name, version, path + ".tmp", log)
+            os.rename(path + ".tmp", path)
+        except (RuntimeError, OSError, IOError) as e:
+            if log != None:
+                log.write("cache export of %s:%s failed: %s\n" % (name, version, e))
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+
+class History:
+    '''
+    Durations of past builds and pushes of every image version, kept in a
+    SQLite database. Estimates average the last samples durations.
+    '''
+    samples = 5
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.durations = {}
+
+    def open(self):
+        if self.connection != None:
+            return
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS durations " \
+            "(phase TEXT, name TEXT, version TEXT, seconds REAL, recorded REAL)")
+        for phase, name, version, seconds in self.connection.execute(
+            "SELECT phase, name, version, seconds FROM durations ORDER BY recorded"):
+            self.sample(phase, (name, version), seconds)
+
+    def sample(self, phase, key, seconds):
+        if not self.durations.has_key((phase, key)):
+            self.durations[(phase, key)] = collections.deque(maxlen=History.samples)
+        self.durations[(phase, key)].append(seconds)
+
+    def record(self, phase, durations):
+        '''
+        durations is a list of ((name, version), seconds)
+        '''
+        self.open()
+        now = time.time()
+        with self.connection:
+            for key, seconds in durations:
+                self.sample(phase, key, seconds)
+                self.connection.execute("DELETE FROM durations WHERE phase = ? AND name = ? AND version = ? " \
+                    "AND recorded < (SELECT MIN(recorded) FROM (SELECT recorded FROM durations " \
+                    "WHERE phase = ? AND name = ? AND version = ? ORDER BY recorded DESC LIMIT ?))",
+                    (phase, key[0], key[1], phase, key[0], key[1], History.samples - 1))
+                self.connection.execute("INSERT INTO durations VALUES (?, ?, ?, ?, ?)",
+                    (phase, key[0], key[1], seconds, now))
+
+    def estimate(self, phase, key):
+        '''
+        Returns None if key never went through phase
+        '''
+        self.open()
+        samples = self.durations.get((phase, key))
+        if samples == None:
+            return None
+        return sum(samples) / len(samples)
+
+    def average(self, phase):
+        '''
+        Average duration of phase over all image versions, None if unknown
+        '''
+        self.open()
+        estimates = [sum(s) / len(s) for (p, key), s in self.durations.items() if p == phase]
+        if len(estimates) == 0:
+            return None
+        return sum(estimates) / len(estimates)
+
+class DockerFarm:
+    '''
+    Spreads images over the backends of several docker hosts, each with its
+    own inventory. An image is built on the host its parent was built on in
+    this run, otherwise on a host that already holds its parent so no layers
+    have to be pulled, the one with the fewest builds running if several do.
+    Images whose parent is on no host go to the host with the fewest builds
+    running.
+    '''
+    def __init__(self, backends):
+        self.backends = backends
+        self.prefix = ""
+        self.placed = {}
+        self.running = dict((b.host, 0) for b in backends)
+        self.lock = threading.Lock()
+
+    def cache_images(self):
+        for b in self.backends:
+            b.prefix = self.prefix
+            b.cache_images()
+
+    def holder(self, name, version):
+        '''
+        Returns the backend that built or holds name:version, None if no
+        host has it
+        '''
+        with self.lock:
+            if self.placed.has_key((name, version)):
+                return self.placed[(name, version)]
+        for b in self.backends:
+            if b.cached_image(name, version):
+                return b
+        return None
+
+    def place(self, name, version, parent=None):
+        '''
+        Picks the backend to build name:version on, parent is the
+        (name, version) it is built from
+        '''
+        with self.lock:
+            candidates = self.backends
+            if parent != None and self.placed.has_key(parent):
+                # other hosts may still hold the parent as it was before this run
+                candidates = [self.placed[parent]]
+            elif parent != None:
+                holders = filter(lambda b: b.cached_image(parent[0], parent[1]), self.backends)
+                if len(holders) > 0:
+                    candidates = holders
+            backend = min(candidates, key=lambda b: self.running[b.host])
+            self.running[backend.host] += 1
+            self.placed[(name, version)] = backend
+            return backend
+
+    def build_image(self, name, version, context, log=None, parent=None, cache=None, sources=[]):
+        '''
+        Returns the host that built the image. cache, if given, is the
+        BuildCache that makes the (name, version) sources available as
+        cache on the host before and keeps the image after the build.
+        '''
+        backend = self.place(name, version, parent)
+        try:
+            cache_from = []
+            if cache != None:
+                cache_from = cache.restore(backend, sources, log)
+            backend.build_image(name, version, context, log, cache_from, cache != None)
+        except Exception:
+            with self.lock:
+                del self.placed[(name, version)]
+            raise
+        finally:
+            with self.lock:
+                self.running[backend.host] -= 1
+        if cache != None:
+            cache.store(backend, name, version, log)
+        return backend.host
+
+    def push_image(self, name, version, log=None):
+        (self.holder(name, version) or self.backends[0]).push_image(name, version, log)
+
+    def image_digests(self, name, version):
+        return (self.holder(name, version) or self.backends[0]).image_digests(name, version)
+
+    def cached_image(self, name, version):
+        return self.holder(name, version) != None
+
+class Scheduler:
+    '''
+    Runs actions of a DAG of nodes on bounded pools of worker threads.
+    A node starts as soon as all the nodes it depends on succeeded, and a
+    failed node only skips its own descendants. Among ready nodes, the one
+    heading the longest path of estimated costs starts first.
+    '''
+    def __init__(self, jobs=1):
+        self.jobs = {None: max(1, jobs)}
+        self.order = []
+        self.actions = {}
+        self.deps = {}
+        self.pools = {}
+        self.costs = {}
+        self.results = {}
+
+    def add_pool(self, pool, jobs):
+        self.jobs[pool] = max(1, jobs)
+
+    def has(self, key):
+        return self.actions.has_key(key)
+
+    def add(self, key, action, deps=[], pool=None, cost=0):
+        '''
+        The action of key runs on the workers of pool, or on the default
+        workers if pool is None. cost is the estimated seconds it takes.
+        deps must have been added before key.
+        '''
+        self.order.append(key)
+        self.actions[key] = action
+        self.deps[key] = list(deps)
+        self.pools[key] = pool
+        self.costs[key] = cost
+
+    def children(self):
+        children = dict((k, []) for k in self.order)
+        for k in self.order:
+            for d in self.deps[k]:
+                children[d].append(k)
+        return children
+
+    def critical_paths(self):
+        '''
+        Returns a dict of node -> estimated seconds from the node's start to
+        the end of its costliest chain of descendants
+        '''
+        children = self.children()
+        paths = {}
+        for k in reversed(self.order):
+            paths[k] = self.costs[k] + max([paths[c] for c in children[k]] or [0])
+        return paths
+
+    def run(self):
+        '''
+        Returns a dict of node -> (status, detail), status is one of OK,
+        Failed or Skipped. detail is the action's return value for OK and
+        the error otherwise.
+        '''
+        children = self.children()
+        paths = self.critical_paths()
+        waiting = dict((k, len(self.deps[k])) for k in self.order)
+
+        # ready nodes are taken longest critical path first, in insertion
+        # order among equals
+        ready = dict((pool, Queue.PriorityQueue()) for pool in self.jobs)
+        sequence = itertools.count()
+        done = Queue.Queue()
+        for k in self.order:
+            if waiting[k] == 0:
+                ready[self.pools[k]].put((-paths[k], next(sequence), k))
+
+        def work(queue):
+            while True:
+                key = queue.get()[2]
+                if key == None:
+                    return
+                try:
+                    done.put((key, "OK", self.actions[key]()))
+                except Exception as e:
+                    done.put((key, "Failed", e))
+
+        workers = []
+        for pool, jobs in self.jobs.items():
+            workers.extend([threading.Thread(target=work, args=(ready[pool],)) for i in range(jobs)])
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        remaining = len(self.order)
+        while remaining > 0:
+            key, status, detail = done.get()
+            remaining -= 1
+            self.results[key] = (status, detail)
+            if status == "OK":
+                for child in children[key]:
+                    waiting[child] -= 1
+                    if waiting[child] == 0 and not self.results.has_key(child):
+                        ready[self.pools[child]].put((-paths[child], next(sequence), child))
+            else:
+                stack = list(children[key])
+                while len(stack) > 0:
+                    child = stack.pop()
+                    if not self.results.has_key(child):
+                        self.results[child] = ("Skipped", "skipped as %s failed" % ':'.join(key))
+                        remaining -= 1
+                        stack.extend(children[child])
+
+        for pool, jobs in self.jobs.items():
+            for i in range(jobs):
+                ready[pool].put((0, next(sequence), None))
+        for w in workers:
+            w.join()
+        return self.results
+
+class Watcher:
+    '''
+    Waits for changes of files under a directory, with inotify where the C
+    library provides it and by polling modification times otherwise
+    '''
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    event_size = struct.calcsize("iIII")
+    # seconds without events after which a burst of changes is complete
+    settle = 0.1
+
+    def __init__(self, root, interval=1.0, poll=False):
+        self.root = root
+        self.interval = interval
+        self.fd = None
+        if not poll:
+            self.fd = self.inotify_init()
+        if self.fd != None:
+            self.mode = "inotify"
+            self.watches = {}
+            self.add_watches(root)
+        else:
+            self.mode = "polling every %.1fs" % interval
+            self.snapshot = self.scan()
+
+    def inotify_init(self):
+        '''
+        Returns None if inotify is not available
+        '''
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = self.libc.inotify_init()
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        return fd
+
+    def add_watches(self, root):
+        for directory, subdirs, files in os.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, directory, Watcher.mask)
+            if wd >= 0:
+                self.watches[wd] = directory
+
+    def wait(self):
+        '''
+        Blocks until files changed, returns their paths once no more
+        changes arrive for a moment
+        '''
+        while True:
+            if self.fd == None:
+                changed = self.poll()
+            else:
+                select.select([self.fd], [], [])
+                changed = set()
+                while True:
+                    changed.update(self.read_events())
+                    if len(select.select([self.fd], [], [], Watcher.settle)[0]) == 0:
+                        break
+            # editors' swap and backup files
+            changed = filter(lambda p: not os.path.basename(p).startswith(".") and not p.endswith("~"), changed)
+            if len(changed) > 0:
+                return sorted(changed)
+
+    def read_events(self):
+        data = os.read(self.fd, 65536)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            name = data[offset + Watcher.event_size:offset + Watcher.event_size + length].rstrip("\0")
+            offset += Watcher.event_size + length
+            if mask & Watcher.IN_Q_OVERFLOW:
+                # events were lost, anything may have changed
+                paths.append(self.root)
+                continue
+            directory = self.watches.get(wd)
+            if directory == None:
+                continue
+            if mask & Watcher.IN_IGNORED:
+                del self.watches[wd]
+                continue
+            path = os.path.join(directory, name) if name != "" else directory
+            if mask & Watcher.IN_ISDIR and mask & (Watcher.IN_CREATE | Watcher.IN_MOVED_TO):
+                self.add_watches(path)
+            paths.append(path)
+        return paths
+
+    def scan(self):
+        snapshot = {}
+        for directory, subdirs, files in os.walk(self.root):
+            for f in files:
+                path = os.path.join(directory, f)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue # removed meanwhile
+                snapshot[path] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def poll(self):
+        time.sleep(self.interval)
+        snapshot = self.scan()
+        changed = filter(lambda p: snapshot.get(p) != self.snapshot.get(p), set(snapshot) | set(self.snapshot))
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        if self.fd != None:
+            os.close(self.fd)
+            self.fd = None
 
 class Project:
     logger = Logger()
-    env = Environment(loader=FileSystemLoader('images'))
     build_dir = "./build"
+    log_dir = build_dir + "/logs"
     image_dir = "./images"
+    cache_dir = "./.dib"
+    digest_file = cache_dir + "/digests.json"
+    manifest_file = cache_dir + "/definitions.json"
+    history_file = cache_dir + "/history.db"
+    push_backoff = 2
+    template_cache_dir = cache_dir + "/templates"
+    env = Environment(loader=FileSystemLoader('images'), bytecode_cache=FileSystemBytecodeCache(template_cache_dir))
 
     def __init__(self):
+        if not os.path.isdir(Project.template_cache_dir):
+            os.makedirs(Project.template_cache_dir)
         self.classes = []
-        self.docker = LocalDocker()
+        self.tracer = Tracer()
+        self.history = History(Project.history_file)
+        self.graph = ImageGraph()
+        self.inventory = False
+        self.docker = DockerFarm([LocalDocker()])
+        self.cache_stats = {}
+        self.registries = {}
+        self.digests = {}
+        self.built_digests = {}
 
     def create_image(self, package_file_path, dockerfile_path=None, files=[]):
         package_template = Project.env.get_template(package_file_path)
@@ -224,20 +1357,53 @@ class Project:
         if dockerfile_path == None:
             dockerfile_template = None
         else:
-            dockerfile_template = Project.env.get_template(dockerfile_path)
-        return Image(package_definition, dockerfile_template, files)
+            dockerfile_template = LazyTemplate(Project.env, dockerfile_path)
+        image = Image(package_definition, dockerfile_template, files)
+        image.path = os.path.normpath(os.path.dirname(package_file_path))
+        return image
+
+    def restore_image(self, package_file_path, fields, dockerfile_path=None, files=[]):
+        if dockerfile_path == None:
+            dockerfile_template = None
+        else:
+            dockerfile_template = LazyTemplate(Project.env, dockerfile_path)
+        image = Image(None, dockerfile_template, files, fields)
+        image.path = os.path.normpath(os.path.dirname(package_file_path))
+        return image
+
+    def signature_of(self, path):
+        stat = os.stat(path)
+        return [stat.st_mtime, stat.st_size]
+
+    def load_manifest(self, shared_signature):
+        '''
+        Returns the parsed definitions of the last run by package file,
+        none of them is valid if templates shared by packages changed
+        '''
+        if not os.path.isfile(Project.manifest_file):
+            return {}
+        try:
+            with io.open(Project.manifest_file, "r", encoding='utf8') as f:
+                manifest = json.load(f)
+        except ValueError as e:
+            self.logger.warn("Ignored definition manifest due to %s" % e)
+            return {}
+        if manifest.get("shared") != shared_signature:
+            return {}
+        return manifest.get("packages", {})
 
+    def save_manifest(self, shared_signature, packages):
+        with io.open(Project.manifest_file, "wb") as f:
+            f.write(json.dumps({"shared": shared_signature, "packages": packages}))
+
+    @traced("macros", summary=False)
     def load_macros(self):
-        temp_file_path = Project.image_dir + "/temp.j2"
-        with io.open(temp_file_path, "w", encoding='utf8') as tempfile:
-            content = u"""
+        content = u"""
 {% import 'macros.j2' as g -%}
 prefix={{g.prefix}}
 suffix={{g.suffix}}
 """
-            tempfile.write(content)
-        temp_template = Project.env.get_template("temp.j2")
-        rendered = temp_template.render()
+        rendered = Project.env.from_string(content).render()
         for line in rendered.splitlines():
             tokens = line.split('=')
             if len(tokens) > 1:
@@ -249,44 +1415,59 @@ suffix={{g.suffix}}
                 if key == "suffix":
                     self.suffix = value
                     #print "suffix: %s" % value
-        os.remove(temp_file_path)
 
+    @traced("load")
     def load_image_definition(self):
         default_dockerfile = 'Dockerfile.j2'
         default_package_file = 'package.j2'
         walk_dir = os.path.abspath(Project.image_dir)
         self.logger.info("Will walk directory %s for image definitions" % walk_dir)
 
+        packages = []
+        shared_signature = []
         for root, subdirs, files in os.walk(walk_dir):
             relative_path = os.path.relpath(root, walk_dir)
+            if os.path.isfile(os.path.join(root, default_package_file)):
+                packages.append((root, relative_path, files))
+            else:
+                # templates outside packages, e.g. macros.j2, may be imported by any package
+                for f in sorted(files):
+                    if f.endswith(".j2"):
+                        shared_signature.append([os.path.join(relative_path, f)] + self.signature_of(os.path.join(root, f)))
+
+        manifest = self.load_manifest(shared_signature)
+        definitions = {}
+        restored = 0
+        for root, relative_path, files in packages:
             package_file_path = os.path.join(relative_path, default_package_file)
             dockerfile_path = os.path.join(relative_path, default_dockerfile)
 
             # print "root %s" % root
             # print "package %s" % package_file_path
-            if os.path.isfile(os.path.join(root, default_package_file)):
-                files.remove(default_package_file)
-                try:
-                    if os.path.isfile(os.path.join(root, default_dockerfile)):
-                        files.remove(default_dockerfile)
-                    else:
-                        dockerfile_path = None
-                    abs_files = [os.path.join(root, f) for f in files]
+            files.remove(default_package_file)
+            try:
+                if os.path.isfile(os.path.join(root, default_dockerfile)):
+                    files.remove(default_dockerfile)
+                else:
+                    dockerfile_path = None
+                abs_files = [os.path.join(root, f) for f in files]
+                signature = self.signature_of(os.path.join(root, default_package_file))
+                entry = manifest.get(package_file_path)
+                if entry != None and entry["signature"] == signature:
+                    image = self.restore_image(package_file_path, entry["fields"], dockerfile_path, abs_files)
+                    restored += 1
+                else:
                     image = self.create_image(package_file_path, dockerfile_path, abs_files)
-                    if len(filter(lambda c: c.name == image.name, self.classes)) > 0:
-                        raise RuntimeError("duplicated image name")
-                    self.classes.append(image)
-                except RuntimeError as e:
-                    self.logger.warn("Ignored path %s due to Error %s" % (package_file_path, e))
+                definitions[package_file_path] = {"signature": signature, "fields": image.fields()}
+                self.graph.add(image)
+                self.classes.append(image)
+            except (RuntimeError, TemplateError) as e:
+                self.logger.warn("Ignored path %s due to Error %s" % (package_file_path, e))
 
-        for i in self.classes:
-            i.parent_images = []
-            for n in i.parents:
-                found = filter(lambda c: c.name == n, self.classes)
-                if len(found) > 0:
-                    i.parent_images.append(found[0])
-                else:
-                    i.parent_images.append(None)
+        self.logger.info("Loaded %i image definitions, %i of them from manifest" % (len(self.classes), restored))
+        if restored < len(definitions) or len(definitions) < len(manifest):
+            self.save_manifest(shared_signature, definitions)
+        self.graph.link()
 
         print "Defined images:"
         for i in self.classes:
@@ -294,38 +1475,142 @@ suffix={{g.suffix}}
 
         self.load_macros()
 
+    @traced("plan")
     def make_plan(self, parsed):
         self.action = parsed.action
+        hosts = getattr(parsed, "docker_host", None)
+        if parsed.backend == "engine":
+            self.docker = DockerFarm(map(DockerEngine, hosts or [parsed.socket]))
+        elif hosts != None:
+            self.docker = DockerFarm(map(LocalDocker, hosts))
+        self.docker.prefix = self.prefix
         try:
             self.force_parents = parsed.parents
         except AttributeError:
             self.force_parents = False
+        try:
+            self.force = parsed.force
+        except AttributeError:
+            self.force = False
+        try:
+            self.jobs = parsed.jobs
+        except AttributeError:
+            self.jobs = 1
+        try:
+            self.context = parsed.context
+        except AttributeError:
+            self.context = "copy"
+        try:
+            self.push_jobs = parsed.push_jobs
+            self.push_retries = parsed.push_retries
+        except AttributeError:
+            self.push_jobs = 1
+            self.push_retries = 0
+        self.plan_push = getattr(parsed, "push", False)
+        self.flatten = getattr(parsed, "flatten", False)
+        self.cache = None
+        if getattr(parsed, "cache_from", False) or getattr(parsed, "cache_dir", None) != None:
+            self.cache = BuildCache(parsed.cache_from, parsed.cache_dir)
 
+        self.parsed = parsed
+        self.watch_build = getattr(parsed, "build", False)
+        self.select_nodes(parsed)
+
+    def select_nodes(self, parsed):
+        '''
+        Sets to_act to the image versions parsed selects
+        '''
         self.to_act = []
         if parsed.name == None:
-            for c in self.classes:
-                for v in c.versions:
-                    self.to_act.append((c, v))
+            for key in self.graph.order:
+                self.to_act.append(self.graph.nodes[key])
         else:
             name = parsed.name
             if not "/" in parsed.name and not name.startswith(self.prefix) and self.prefix != "":
                 name = self.prefix + name
                 self.logger.warn("Replace name %s with %s when prefix is defined" % (parsed.name, name))
             if parsed.version == None:
-                filtered = filter(lambda c: c.name == name, self.classes)
-                if len(filtered) > 0:
-                    for v in filtered[0].versions:
-                        self.to_act.append((filtered[0], v))
+                if self.graph.images.has_key(name):
+                    for v in self.graph.images[name].versions:
+                        if self.graph.nodes.has_key((name, v)):
+                            self.to_act.append(self.graph.nodes[(name, v)])
                 else:
                     raise RuntimeError("Image named %s not found" % name)
             else:
-                filtered = filter(lambda c: c.name == name and len(filter(lambda v: v == parsed.version, c.versions)) > 0, self.classes)
-                if len(filtered) > 0:
-                    self.to_act.append((filtered[0], parsed.version))
+                if self.graph.nodes.has_key((name, parsed.version)):
+                    self.to_act.append(self.graph.nodes[(name, parsed.version)])
                 else:
                     raise RuntimeError("Image named %s version %s not found" % (name, parsed.version))
 
+        changed = None
+        if getattr(parsed, "changed_since", None) != None:
+            changed = self.changed_paths(parsed.changed_since)
+        if getattr(parsed, "changed", None) != None:
+            changed = (changed or []) + parsed.changed
+        if changed != None:
+            affected = self.affected_nodes(changed)
+            self.to_act = filter(lambda cv: (cv[0].name, cv[1]) in affected, self.to_act)
+            self.logger.info("%i image versions affected by %i changed files" % (len(self.to_act), len(changed)))
+        if self.flatten:
+            # ancestors are built as stages of the leaves' Dockerfiles
+            keys = set(map(lambda cv: (cv[0].name, cv[1]), self.to_act))
+            self.to_act = filter(lambda cv: not any(k in keys for k in self.graph.children[(cv[0].name, cv[1])]), self.to_act)
+            self.logger.info("%i leaf image versions to flatten" % len(self.to_act))
+
+    def cache_images(self):
+        '''
+        Lists the images of the docker hosts on first use only, builds add
+        their images to the inventory afterwards
+        '''
+        if not self.inventory:
+            self.list_images()
+
+    @traced("inventory", summary=False)
+    def list_images(self):
         self.docker.cache_images()
+        self.inventory = True
+
+    def changed_paths(self, ref):
+        '''
+        Files changed in the work tree since git ref, including untracked ones
+        '''
+        try:
+            diff = subprocess.check_output(["git", "diff", "--name-only", "--relative", ref, "--"])
+            untracked = subprocess.check_output(["git", "ls-files", "--others", "--exclude-standard"])
+        except (CalledProcessError, OSError) as e:
+            raise RuntimeError("Failed to list files changed since %s: %s" % (ref, e))
+        return diff.splitlines() + untracked.splitlines()
+
+    def affected_nodes(self, paths):
+        '''
+        Returns the set of nodes whose definitions are changed by paths, and
+        all their descendants. A path anywhere in a definition directory
+        changes that definition, a template outside them (e.g. macros.j2)
+        or the images directory itself affects every image, other files and
+        directories outside definitions affect none.
+        '''
+        names = set()
+        for p in paths:
+            relative_path = self.relative_path(p)
+            if relative_path.startswith(os.pardir):
+                continue
+            name = self.image_of(p)
+            if name != None:
+                names.add(name)
+            elif relative_path == os.curdir or (p.endswith(".j2") and os.path.basename(p) != "package.j2" \
+                and not os.path.isdir(p)):
+                self.logger.info("%s is shared by image definitions, all images are affected" % p)
+                names = set(self.graph.names)
+                break
+
+        affected = set()
+        for name in names:
+            for v in self.graph.images[name].versions:
+                key = (name, v)
+                if self.graph.nodes.has_key(key) and not key in affected:
+                    affected.add(key)
+                    affected.update(self.graph.descendants(key))
+        return affected
 
     def take_action(self):
         if self.action == "generate":
@@ -337,137 +1622,611 @@ suffix={{g.suffix}}
             self.logger.summary(['generate', 'build'])
         elif self.action == "push":
             self.generate_dockerfiles()
-            self.build_images()
-            self.push_images()
+            self.build_and_push_images()
             self.logger.summary(['generate', 'build', 'push'])
         elif self.action == "clean":
             self.clean_images()
             self.logger.summary(['clean'])
+        elif self.action == "plan":
+            self.generate_dockerfiles()
+            self.print_plan()
+        elif self.action == "watch":
+            self.watch()
 
-    def generate_dockerfiles(self):
-        if os.path.isdir(Project.build_dir):
-            shutil.rmtree(Project.build_dir)
+    def watch(self):
+        '''
+        Generates to_act, and builds it if asked, then does so again for the
+        image versions affected by every change under the images directory
+        until interrupted
+        '''
+        phases = ['generate', 'build'] if self.watch_build else ['generate']
+        self.generate_dockerfiles()
+        if self.watch_build:
+            self.build_images()
+        self.logger.summary(phases)
+
+        watcher = Watcher(Project.image_dir, self.parsed.interval, self.parsed.poll)
+        try:
+            while True:
+                self.logger.info("Watching %s for changes (%s), press Ctrl-C to stop" % (Project.image_dir, watcher.mode))
+                paths = watcher.wait()
+                begin = time.time()
+                self.logger.reset()
+                # a template saved half-written must not end the watch
+                try:
+                    self.update(paths)
+                    if len(self.to_act) > 0:
+                        self.generate_dockerfiles()
+                        if self.watch_build:
+                            self.build_images()
+                except (RuntimeError, TemplateError) as e:
+                    self.logger.error("%s" % e)
+                    continue
+                self.logger.summary(phases)
+                self.logger.info("Updated %i image versions for %i changed files in %.2fs" % \
+                    (len(self.to_act), len(paths), time.time() - begin))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
 
-        os.mkdir(Project.build_dir)
+    def update(self, paths):
+        '''
+        Brings the loaded definitions up to date with the changed paths and
+        sets to_act to the selected image versions they affect
+        '''
+        if self.needs_reload(paths):
+            self.logger.info("Definitions changed, reloading them")
+            classes, graph = self.classes, self.graph
+            self.classes = []
+            self.graph = ImageGraph()
+            try:
+                self.load_image_definition()
+            except (RuntimeError, TemplateError):
+                self.classes, self.graph = classes, graph
+                raise
+        else:
+            for p in paths:
+                name = self.image_of(p)
+                template = self.graph.images[name].template
+                if template != None and os.path.normpath(template.path) == self.relative_path(p):
+                    template.reset()
+        affected = self.affected_nodes(paths)
+        self.select_nodes(self.parsed)
+        self.to_act = filter(lambda cv: (cv[0].name, cv[1]) in affected, self.to_act)
 
+    def relative_path(self, path):
+        return os.path.normpath(os.path.relpath(os.path.abspath(path), os.path.abspath(Project.image_dir)))
+
+    def image_of(self, path):
+        '''
+        Returns the name of the image whose definition directory contains
+        path, at any depth, None if path is in no definition
+        '''
+        relative_path = self.relative_path(path)
+        directory = relative_path if os.path.isdir(path) else os.path.dirname(relative_path)
+        while True:
+            name = self.graph.paths.get(os.path.normpath(directory))
+            if name != None or directory in ("", os.curdir):
+                return name
+            directory = os.path.dirname(directory)
+
+    def needs_reload(self, paths):
+        '''
+        Whether paths change definitions, rather than only the content of
+        templates and support files
+        '''
+        for p in paths:
+            name = self.image_of(p)
+            if name == None or os.path.basename(p) == 'package.j2' or not os.path.isfile(p):
+                return True
+            image = self.graph.images[name]
+            if not os.path.abspath(p) in map(os.path.abspath, image.files) and \
+                (image.template == None or os.path.normpath(image.template.path) != self.relative_path(p)):
+                return True
+        return False
+
+    @traced("generate")
+    def generate_dockerfiles(self):
+        if not os.path.isdir(Project.build_dir):
+            os.mkdir(Project.build_dir)
+
+        self.generated = set()
+        self.artifacts = {"unchanged": 0, "rewritten": 0, "deleted": 0}
         bad_cvs = []
         for cv in self.to_act:
             c = cv[0]
             v = cv[1]
             try:
-                self.generate_dockerfile(c, v)
-                self.logger.summary_ok("generate", "generate Dockerfile for %s:%s" % (c.name, v))
+                if not (c.name, v) in self.generated:
+                    self.generate_dockerfile(c, v)
+                self.logger.summary_ok("generate", "generate Dockerfile for %s:%s [%.2fs]" % \
+                    (c.name, v, self.tracer.duration("generate", (c.name, v))))
             except RuntimeError as e:
                 bad_cvs.append(cv)
                 self.logger.warn("Ignored generating Dockerfile for %s:%s due to " \
                 "one or more of its parent versions not found in mappings: %s" % \
                 (c.name, v, e))
                 self.logger.summary_fail("generate", "generate Dockerfile for %s:%s" % (c.name, v), e)
+            except TemplateError as e:
+                bad_cvs.append(cv)
+                self.logger.warn("Ignored generating Dockerfile for %s:%s due to template error: %s" % \
+                (c.name, v, e))
+                self.logger.summary_fail("generate", "generate Dockerfile for %s:%s" % (c.name, v), e)
         for cv in bad_cvs:
             self.to_act.remove(cv)
 
+        self.remove_orphans()
+        message = "%i artifacts unchanged, %i rewritten, %i deleted" % \
+            (self.artifacts["unchanged"], self.artifacts["rewritten"], self.artifacts["deleted"])
+        self.logger.info("Generated %s" % message)
+        self.logger.summary_ok("generate", message)
+
+    @traced("generate", per_image=True)
     def generate_dockerfile(self, c, v):
         class_dir = Project.build_dir + "/" + os.path.basename(c.name)
         if not os.path.isdir(class_dir):
             os.mkdir(class_dir)
 
         version_dir = class_dir + "/" + v
+        if not c.mappings.has_key(v):
+            if os.path.isdir(version_dir):
+                self.remove_artifact(version_dir)
+            raise RuntimeError("Image %s's mappings do not contain version %s" % (c.name, v))
+
+        if self.flatten:
+            rendered = self.flatten_dockerfile(c, v)
+        else:
+            parent_image = self.graph.images.get(c.mappings[v][0])
+            if parent_image != None and not c.mappings[v] in self.generated:
+                self.generate_dockerfile(parent_image, c.mappings[v][1])
+            rendered = self.render(c, v)
+
         if not os.path.isdir(version_dir):
             os.mkdir(version_dir)
-            if c.mappings.has_key(v):
-                parent_name = c.mappings[v][0]
-                parent_version = c.mappings[v][1]
-                parent_index = c.parents.index(parent_name) # parent_name must be in parents because of mappings parsing
-                parent_image = c.parent_images[parent_index]
-                if c.parent_images[parent_index] != None:
-                    self.generate_dockerfile(parent_image, parent_version)
-                rendered = c.template.render(name=c.name, version=v, parent=parent_name, parent_version=parent_version)
+        self.write_artifact(version_dir + "/Dockerfile", rendered.encode('utf8'))
+        expected = set(["Dockerfile"])
+        if self.context != "tar":
+            # with tar contexts support files are read from the images directory
+            for source, arcname in self.context_files(c, v):
+                directory = os.path.join(version_dir, os.path.dirname(arcname))
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                self.copy_artifact(source, directory)
+                expected.add(arcname)
+                expected.add(os.path.dirname(arcname))
+        for root, dirs, names in os.walk(version_dir):
+            for f in list(dirs) + names:
+                path = os.path.join(root, f)
+                if not os.path.relpath(path, version_dir) in expected:
+                    self.remove_artifact(path)
+                    if f in dirs:
+                        dirs.remove(f)
+        self.generated.add((c.name, v))
+
+    def render(self, c, v):
+        '''
+        Renders the Dockerfile of c:v and records the digest of its inputs,
+        the digest of its parent must be recorded before
+        '''
+        parent_name, parent_version = c.mappings[v]
+        rendered = c.template.render(name=c.name, version=v, parent=parent_name, parent_version=parent_version)
+        parent_digest = self.digests.get((parent_name, parent_version), "%s:%s" % (parent_name, parent_version))
+        self.digests[(c.name, v)] = self.digest_of(rendered, c.files, parent_digest)
+        return rendered
+
+    def chain_of(self, c, v):
+        '''
+        Returns the nodes c:v is built from, from its oldest ancestor defined
+        in the project down to c:v itself
+        '''
+        chain = [(c, v)]
+        parent = self.parent_node(c, v)
+        while parent != None:
+            chain.insert(0, parent)
+            parent = self.parent_node(parent[0], parent[1])
+        return chain
+
+    def stage_name(self, c, v):
+        return re.sub("[^a-z0-9_.-]", "-", ("%s-%s" % (os.path.basename(c.name), v)).lower())
+
+    def flatten_dockerfile(self, c, v):
+        '''
+        Renders c:v and its ancestors as the stages of one multi-stage
+        Dockerfile, every ancestor is a stage the next one is built from
+        '''
+        stages = []
+        previous = None
+        for image, version in self.chain_of(c, v):
+            if not image.mappings.has_key(version):
+                raise RuntimeError("Image %s's mappings do not contain version %s" % (image.name, version))
+            stage = Stage(self.stage_name(image, version), "%s:%s" % image.mappings[version], previous)
+            stages.append(stage.rewrite(self.render(image, version)))
+            previous = stage.name
+        return "\n".join(stages)
+
+    def context_files(self, c, v):
+        '''
+        (source, arcname) pairs of the support files of c:v's build context,
+        when flattened every stage's files are in a directory named after it
+        '''
+        if self.flatten:
+            files = []
+            for image, version in self.chain_of(c, v):
+                stage = self.stage_name(image, version)
+                files.extend([(f, stage + "/" + os.path.basename(f)) for f in image.files])
+            return files
+        return [(f, os.path.basename(f)) for f in c.files]
+
+    def write_artifact(self, path, content):
+        '''
+        Writes content to path unless path already has the same content
+        '''
+        if os.path.isfile(path):
+            with io.open(path, "rb") as f:
+                if f.read() == content:
+                    self.artifacts["unchanged"] += 1
+                    return
+        with io.open(path, "wb") as f:
+            f.write(content)
+        self.artifacts["rewritten"] += 1
+
+    def copy_artifact(self, source, directory):
+        '''
+        Copies or hard links source into directory unless it is already there
+        '''
+        target = os.path.join(directory, os.path.basename(source))
+        if os.path.isfile(target):
+            if os.path.samefile(source, target) or \
+                (self.context != "link" and filecmp.cmp(source, target, shallow=False)):
+                self.artifacts["unchanged"] += 1
+                return
+            os.remove(target)
+        self.artifacts["rewritten"] += 1
+        if self.context == "link":
+            try:
+                os.link(source, target)
+                return
+            except OSError:
+                pass # e.g. build directory on another file system
+        shutil.copy2(source, target)
+
+    def remove_artifact(self, path):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        self.artifacts["deleted"] += 1
+
+    def remove_orphans(self):
+        '''
+        Removes generated version directories whose image or version is no
+        longer defined
+        '''
+        versions = {}
+        for c in self.classes:
+            versions.setdefault(os.path.basename(c.name), set()).update(c.versions)
+
+        for class_name in os.listdir(Project.build_dir):
+            class_dir = os.path.join(Project.build_dir, class_name)
+            if not os.path.isdir(class_dir) or class_name == os.path.basename(Project.log_dir):
+                continue
+            if not versions.has_key(class_name):
+                self.remove_artifact(class_dir)
+                continue
+            for v in os.listdir(class_dir):
+                if not v in versions[class_name]:
+                    self.remove_artifact(os.path.join(class_dir, v))
+
+    def digest_of(self, rendered, files, parent_digest):
+        '''
+        Digest of everything an image version is built from: its rendered
+        Dockerfile, its support files and its parent's digest
+        '''
+        sha = hashlib.sha256()
+        sha.update(parent_digest.encode('utf8'))
+        sha.update(rendered.encode('utf8'))
+        for f in sorted(files):
+            sha.update(os.path.basename(f).encode('utf8'))
+            with io.open(f, "rb") as content:
+                for block in iter(lambda: content.read(65536), b''):
+                    sha.update(block)
+        return sha.hexdigest()
+
+    def load_digests(self):
+        self.built_digests = {}
+        if os.path.isfile(Project.digest_file):
+            with io.open(Project.digest_file, "r", encoding='utf8') as f:
+                self.built_digests = json.load(f)
+
+    def save_digests(self):
+        if not os.path.isdir(Project.cache_dir):
+            os.makedirs(Project.cache_dir)
+        with io.open(Project.digest_file, "wb") as f:
+            f.write(json.dumps(self.built_digests, indent=2, sort_keys=True))
+
+    def up_to_date(self, c, v):
+        '''
+        Whether c:v exists locally and was built from the same inputs
+        '''
+        digest = self.digests.get((c.name, v))
+        return digest != None and \
+            self.built_digests.get("%s:%s" % (c.name, v)) == digest and \
+            self.docker.cached_image(c.name, v)
+
+    def parent_node(self, c, v):
+        '''
+        Returns (parent_image, parent_version) that c:v is built on, or None
+        if c:v has no mapping or its parent is not defined in the project
+        '''
+        parent = self.graph.parent.get((c.name, v))
+        if parent == None:
+            return None
+        return self.graph.nodes[parent]
+
+    def make_schedule(self, action, follow, jobs=1, cost=None):
+        '''
+        Makes the execution plan of to_act, every (name, version) node is
+        added once no matter how many descendants depend on it. follow
+        decides whether a node's parent is also part of the plan, cost, if
+        given, estimates the seconds action takes on a node.
+        '''
+        scheduler = Scheduler(jobs)
+        def add(c, v):
+            key = (c.name, v)
+            if scheduler.has(key):
+                return key
+            deps = []
+            parent = self.parent_node(c, v)
+            if parent != None and follow(parent[0], parent[1]):
+                deps.append(add(parent[0], parent[1]))
+            scheduler.add(key, lambda: action(c, v), deps, cost=cost(c, v) if cost != None else 0)
+            return key
+
+        for cv in self.to_act:
+            add(cv[0], cv[1])
+        return scheduler
+
+    def run_phase(self, phase, action, follow, jobs=1):
+        '''
+        Runs action once on every node of phase's plan and summarizes the
+        results
+        '''
+        scheduler = self.make_schedule(action, follow, jobs)
+        results = scheduler.run()
+        self.summarize(phase, scheduler.order, results)
+
+    def summarize(self, phase, keys, results):
+        for key in keys:
+            status, e = results[key]
+            if status == "OK":
+                message = "%s image %s:%s" % (phase, key[0], key[1])
+                if e != None:
+                    message = "%s (%s)" % (message, e)
+                self.logger.summary_ok(phase, "%s [%.2fs]" % (message, self.tracer.duration(phase, key)))
+            else:
+                self.logger.warn("Failed to %s image %s version %s due to %s" % \
+                (phase, key[0], key[1], e))
+                self.logger.summary_fail(phase, "%s image %s:%s" % (phase, key[0], key[1]), e)
+
+    def estimate(self, phase, c, v):
+        '''
+        Estimated seconds phase takes on c:v from its past durations, or
+        from the average of all images if it has none
+        '''
+        if phase == "build" and not self.force and self.up_to_date(c, v):
+            return 0
+        seconds = self.history.estimate(phase, (c.name, v))
+        if seconds == None:
+            seconds = self.history.average(phase)
+        return seconds or 0
+
+    def record_history(self, phase, results):
+        '''
+        Records how long the nodes of phase took, unless they were skipped
+        '''
+        durations = []
+        for key, (status, detail) in results.items():
+            if status == "OK" and not detail in ["unchanged", "in registry"]:
+                durations.append((key, self.tracer.duration(phase, key)))
+        try:
+            self.history.record(phase, durations)
+        except sqlite3.Error as e:
+            self.logger.warn("Failed to record %s durations in %s due to %s" % (phase, Project.history_file, e))
+
+    def build_schedule(self, push=False):
+        '''
+        Makes the plan of building to_act and, if push, of pushing every
+        image on the push pool as soon as it is built
+        '''
+        self.load_digests()
+        self.to_build = set(map(lambda cv: (cv[0].name, cv[1]), self.to_act))
+        # flattened ancestors are stages, never images of their own
+        follow = self.need_build if not self.flatten else lambda c, v: False
+        scheduler = self.make_schedule(self.build_image, follow, self.jobs,
+            lambda c, v: self.estimate("build", c, v))
+        if push:
+            scheduler.add_pool("push", self.push_jobs)
+            pushes = self.make_schedule(self.push_image, lambda c, v: self.force_parents and not self.flatten,
+                cost=lambda c, v: self.estimate("push", c, v))
+            for key in pushes.order:
+                deps = [key] if scheduler.has(key) else []
+                scheduler.add(("push",) + key, pushes.actions[key], deps, "push", pushes.costs[key])
+        return scheduler
+
+    def print_plan(self):
+        '''
+        Prints the nodes building, or building and pushing, to_act would run
+        with their estimated durations, then the estimated total time and
+        critical path
+        '''
+        self.cache_images()
+        scheduler = self.build_schedule(self.plan_push)
+        paths = scheduler.critical_paths()
+        children = scheduler.children()
+        skipped = 0
+        unknown = 0
+        # depth first from the roots, so every node is printed under its parent
+        stack = [(k, 0) for k in reversed(scheduler.order) if len(scheduler.deps[k]) == 0]
+        while len(stack) > 0:
+            key, depth = stack.pop()
+            stack.extend([(k, depth + 1) for k in reversed(children[key])])
+            phase, node = ("push", key[1:]) if key[0] == "push" else ("build", key)
+            c = self.graph.images[node[0]]
+            if phase == "build" and not self.force and self.up_to_date(c, node[1]):
+                skipped += 1
+                note = "skip as up to date"
+            elif self.history.estimate(phase, node) == None:
+                unknown += 1
+                note = "%.2fs, no history" % scheduler.costs[key]
             else:
-                rendered = None
-                shutil.rmtree(version_dir)
-                raise RuntimeError("Image %s's mappings do not contain version %s" % (c.name, v))
+                note = "%.2fs, critical path %.2fs" % (scheduler.costs[key], paths[key])
+            print "%s%s %s:%s (%s)" % ("  " * depth, phase, node[0], node[1], note)
+
+        total = sum(scheduler.costs.values())
+        critical = max(paths.values() or [0])
+        self.logger.info("%i nodes planned, %i skipped as up to date, %i without history" % \
+            (len(scheduler.order), skipped, unknown))
+        self.logger.info("Estimated %.2fs of work, critical path %.2fs, at least %.2fs with %i jobs" % \
+            (total, critical, max(critical, total / max(1, self.jobs)), self.jobs))
 
-            if rendered != None:
-                with io.open(version_dir + "/Dockerfile", "w", encoding='utf8') as dockerfile:
-                    dockerfile.write(rendered)
-                for f in c.files:
-                    shutil.copy2(f, version_dir)
+    def summarize_cache(self):
+        steps = sum(map(lambda s: s[0], self.cache_stats.values()))
+        cached = sum(map(lambda s: s[1], self.cache_stats.values()))
+        self.logger.summary_ok("build", "%i of %i build steps cached" % (cached, steps))
 
+    @traced("build")
     def build_images(self):
-        self.docker.cache_images()
+        self.cache_images()
+        scheduler = self.build_schedule()
+        try:
+            results = scheduler.run()
+        finally:
+            self.save_digests()
+        self.summarize("build", scheduler.order, results)
+        self.summarize_cache()
+        self.record_history("build", results)
 
-        for cv in self.to_act:
-            c = cv[0]
-            v = cv[1]
-            try:
-                self.build_image(c, v)
-                self.logger.summary_ok("build", "build image %s:%s" % (c.name, v))
-            except RuntimeError as e:
-                self.logger.warn("Failed to build image %s version %s due to %s" % \
-                (c.name, v, e))
-                self.logger.summary_fail("build", "build image %s:%s" % (c.name, v), e)
+    def need_build(self, c, v):
+        # a parent that is built in this run must be ready before its children,
+        # a parent whose inputs changed must be rebuilt before them
+        return self.force_parents or (c.name, v) in self.to_build or \
+            not self.up_to_date(c, v)
 
+    @traced("build", per_image=True)
     def build_image(self, c, v):
-        if c.mappings.has_key(v):
-            parent_name = c.mappings[v][0]
-            parent_version = c.mappings[v][1]
-            parent_index = c.parents.index(parent_name) # parent_name must be in parents because of mappings parsing
-            parent_image = c.parent_images[parent_index]
-            if parent_image != None:
-                if self.force_parents or not self.docker.cached_image(parent_name, parent_version):
-                    self.build_image(parent_image, parent_version)
-        else:
+        if not c.mappings.has_key(v):
             raise RuntimeError("Image %s's mappings do not contain version %s" % (c.name, v))
 
+        if not self.force and self.up_to_date(c, v):
+            self.logger.info("Image %s:%s is up to date, skip building" % (c.name, v))
+            return "unchanged"
+
         self.logger.info("Build image %s:%s ..." % (c.name, v))
         path = Project.build_dir + "/" + os.path.basename(c.name) + "/" + v
-        self.docker.build_image(c.name, v, path)
+        if self.context == "tar":
+            context = BuildContext(path, self.context_files(c, v))
+        else:
+            context = BuildContext(path)
+        log = BuildLog(self.log_path(c, v, "build"), "%s:%s" % (os.path.basename(c.name), v))
+        try:
+            host = self.docker.build_image(c.name, v, context, log, c.mappings[v], self.cache, self.cache_sources(c, v))
+        except RuntimeError as e:
+            raise RuntimeError("%s, %s" % (e, log.report()))
+        finally:
+            log.close()
+        self.built_digests["%s:%s" % (c.name, v)] = self.digests[(c.name, v)]
+        self.cache_stats[(c.name, v)] = (log.steps, log.cached)
+        details = ["%i of %i steps cached" % (log.cached, log.steps)]
+        if len(self.docker.backends) > 1:
+            details.append("on %s" % host)
+        return ", ".join(details)
 
-    def push_images(self):
-        for cv in self.to_act:
-            c = cv[0]
-            v = cv[1]
-            try:
-                self.push_image(c, v)
-                self.logger.summary_ok("push", "push image %s:%s" % (c.name, v))
-            except RuntimeError as e:
-                self.logger.warn("Failed to push image %s version %s due to %s" % \
-                (c.name, v, e))
-                self.logger.summary_fail("push", "push image %s:%s" % (c.name, v), e)
+    def cache_sources(self, c, v):
+        '''
+        Images c:v may reuse layers of: its own previous build, the version
+        defined before it and its parent
+        '''
+        sources = [(c.name, v)]
+        index = c.versions.index(v)
+        if index > 0:
+            sources.append((c.name, c.versions[index - 1]))
+        sources.append(c.mappings[v])
+        return sources
+
+    def log_path(self, c, v, phase):
+        return "%s/%s/%s.%s.log" % (Project.log_dir, os.path.basename(c.name), v, phase)
+
+    @traced("pipeline")
+    def build_and_push_images(self):
+        '''
+        Builds images and pushes each one on its own pool of workers as soon
+        as it is built, while the builds of its descendants go on
+        '''
+        self.cache_images()
+        scheduler = self.build_schedule(push=True)
+        try:
+            results = scheduler.run()
+        finally:
+            self.save_digests()
+
+        builds = filter(lambda k: k[0] != "push", scheduler.order)
+        pushes = map(lambda k: k[1:], filter(lambda k: k[0] == "push", scheduler.order))
+        build_results = dict((k, results[k]) for k in builds)
+        push_results = dict((k, results[("push",) + k]) for k in pushes)
+        self.summarize("build", builds, build_results)
+        self.summarize_cache()
+        self.summarize("push", pushes, push_results)
+        self.record_history("build", build_results)
+        self.record_history("push", push_results)
+        pushed = filter(lambda r: r == ("OK", None), push_results.values())
+        in_registry = filter(lambda r: r == ("OK", "in registry"), push_results.values())
+        self.logger.summary_ok("push", "%i images pushed, %i skipped as already in registry" % (len(pushed), len(in_registry)))
 
+    def in_registry(self, c, v):
+        '''
+        Whether the registry's manifest of c:v is the one of the local image
+        '''
+        host, repository = Registry.split(c.name)
+        if not self.registries.has_key(host):
+            self.registries[host] = Registry(host)
+        try:
+            remote = self.registries[host].manifest_digest(repository, v)
+            if remote == None:
+                return False
+            return "%s@%s" % (c.name, remote) in self.docker.image_digests(c.name, v)
+        except RuntimeError as e:
+            self.logger.warn("Cannot compare image %s:%s with its registry due to %s" % (c.name, v, e))
+            return False
+
+    @traced("push", per_image=True)
     def push_image(self, c, v):
-        if c.mappings.has_key(v):
-            parent_name = c.mappings[v][0]
-            parent_version = c.mappings[v][1]
-            parent_index = c.parents.index(parent_name) # parent_name must be in parents because of mappings parsing
-            parent_image = c.parent_images[parent_index]
-            if parent_image != None and self.force_parents:
-                self.push_image(parent_image, parent_version)
+        if not self.force and self.in_registry(c, v):
+            self.logger.info("Image %s:%s is already in the registry, skip pushing" % (c.name, v))
+            return "in registry"
 
         self.logger.info("Push image %s:%s ..." % (c.name, v))
-        self.docker.push_image(c.name, v)
+        log = BuildLog(self.log_path(c, v, "push"), "%s:%s" % (os.path.basename(c.name), v))
+        try:
+            for attempt in range(self.push_retries + 1):
+                try:
+                    self.docker.push_image(c.name, v, log)
+                    return
+                except RuntimeError as e:
+                    if attempt == self.push_retries:
+                        raise RuntimeError("%s, %s" % (e, log.report()))
+                    delay = Project.push_backoff * 2 ** attempt
+                    self.logger.warn("Failed to push image %s version %s due to %s, retry in %is" % (c.name, v, e, delay))
+                    time.sleep(delay)
+        finally:
+            log.close()
 
+    @traced("clean")
     def clean_images(self):
-        for cv in self.to_act:
-            c = cv[0]
-            v = cv[1]
-            try:
-                self.clean_image(c, v)
-                self.logger.summary_ok("clean", "clean image %s:%s" % (c.name, v))
-            except RuntimeError as e:
-                self.logger.warn("Failed to clean image %s version %s due to %s" % \
-                (c.name, v, e))
-                self.logger.summary_fail("clean", "clean image %s:%s" % (c.name, v), e)
+        self.run_phase("clean", self.clean_image, lambda c, v: self.force_parents)
 
+    @traced("clean", per_image=True)
     def clean_image(self, c, v):
-        if c.mappings.has_key(v):
-            parent_name = c.mappings[v][0]
-            parent_version = c.mappings[v][1]
-            parent_index = c.parents.index(parent_name) # parent_name must be in parents because of mappings parsing
-            parent_image = c.parent_images[parent_index]
-            if parent_image != None and self.force_parents:
-                self.clean_image(parent_image, parent_version)
-
         self.logger.info("Clean image %s:%s ..." % (c.name, v))
         class_dir = Project.build_dir + "/" + os.path.basename(c.name)
         version_dir = class_dir + "/" + v
@@ -478,24 +2237,53 @@ if __name__ == "__main__":
     """
     python dib.py [operation] [options]
     operation:
-        generate [-n <name>] [-v <version>]
-        build [-n <name>] [-v <version>] [-p]
-        push [-n <name>] [-v <version>] [-p]
+        generate [-n <name>] [-v <version>] [--changed-since <ref>] [--changed <path> ...] [--context copy|link|tar] [--flatten]
+        build [-n <name>] [-v <version>] [-p] [-f] [-j <jobs>] [--cache-from] [--cache-dir <dir>] [--changed-since <ref>] [--changed <path> ...] [--context copy|link|tar] [--flatten]
+        push [-n <name>] [-v <version>] [-p] [-f] [-j <jobs>] [--push-jobs <jobs>] [--push-retries <retries>] [--cache-from] [--cache-dir <dir>] [--changed-since <ref>] [--changed <path> ...] [--context copy|link|tar] [--flatten]
+        plan [-n <name>] [-v <version>] [-p] [-f] [-j <jobs>] [--push] [--changed-since <ref>] [--changed <path> ...] [--context copy|link|tar] [--flatten]
+        watch [-n <name>] [-v <version>] [--build] [-p] [-f] [-j <jobs>] [--poll] [--interval <seconds>] [--context copy|link|tar] [--flatten]
         clean [-n <name>] [-v <version>] [-p]
     """
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(help='actions', dest="action")
     parser_subs = []
-    parser_subs.append(subparsers.add_parser('generate', help='generate Dockerfiles based on templates'))
+    parser_generate = subparsers.add_parser('generate', help='generate Dockerfiles based on templates')
+    parser_subs.append(parser_generate)
 
     parser_build = subparsers.add_parser('build', help='build images on generated Dockerfiles')
-    parser_build.add_argument('-p', '--parents', action="store_true", help="force build dependent parent images")
+    parser_build.add_argument('-p', '--parents', action="store_true", help="also build dependent parent images whose inputs changed (with -f, rebuild them all)")
+    parser_build.add_argument('-f', '--force', action="store_true", help="build images even if their inputs are unchanged")
+    parser_build.add_argument('-j', '--jobs', type=int, default=1, help="number of images to build in parallel")
     parser_subs.append(parser_build)
 
     parser_push = subparsers.add_parser('push', help='push built images')
-    parser_push.add_argument('-p', '--parents', action="store_true", help="force push dependent parent images")
+    parser_push.add_argument('-p', '--parents', action="store_true", help="also build and push dependent parent images that changed (with -f, rebuild and push them all)")
+    parser_push.add_argument('-f', '--force', action="store_true", help="build and push images even if they are unchanged")
+    parser_push.add_argument('-j', '--jobs', type=int, default=1, help="number of images to build in parallel")
+    parser_push.add_argument('--push-jobs', type=int, default=1, help="number of images to push in parallel")
+    parser_push.add_argument('--push-retries', type=int, default=2, help="number of times a failed push is retried")
     parser_subs.append(parser_push)
 
+    parser_plan = subparsers.add_parser('plan', help='print what build would do and how long it is estimated to take')
+    parser_plan.add_argument('-p', '--parents', action="store_true", help="also build dependent parent images whose inputs changed (with -f, rebuild them all)")
+    parser_plan.add_argument('-f', '--force', action="store_true", help="build images even if their inputs are unchanged")
+    parser_plan.add_argument('-j', '--jobs', type=int, default=1, help="number of images to build in parallel")
+    parser_plan.add_argument('--push', action="store_true", help="also plan pushing the built images")
+    parser_subs.append(parser_plan)
+
+    parser_watch = subparsers.add_parser('watch', help='regenerate Dockerfiles whenever image definitions change')
+    parser_watch.add_argument('--build', action="store_true", help="also build the regenerated images")
+    parser_watch.add_argument('-p', '--parents', action="store_true", help="also build dependent parent images whose inputs changed (with -f, rebuild them all)")
+    parser_watch.add_argument('-f', '--force', action="store_true", help="build images even if their inputs are unchanged")
+    parser_watch.add_argument('-j', '--jobs', type=int, default=1, help="number of images to build in parallel")
+    parser_watch.add_argument('--poll', action="store_true", help="poll for changes instead of using inotify")
+    parser_watch.add_argument('--interval', type=float, default=1.0, help="seconds between polls")
+    parser_watch.add_argument('--context', choices=['copy', 'link', 'tar'], default='copy',
+        help='copy or hard link support files into build directories, or stream them into the build context as a tar')
+    parser_watch.add_argument('--flatten', action="store_true",
+        help='render every leaf image and its ancestors as one multi-stage Dockerfile')
+    parser_subs.append(parser_watch)
+
     parser_clean = subparsers.add_parser('clean', help='clean build directory')
     parser_clean.add_argument('-p', '--parents', action="store_true", help="force clean dependent parent images' build directories")
     parser_subs.append(parser_clean)
@@ -503,6 +2291,25 @@ if __name__ == "__main__":
     for sub in parser_subs:
         sub.add_argument('-n', '--name', help='image name')
         sub.add_argument('-v', '--version', help='image version')
+        sub.add_argument('--backend', choices=['cli', 'engine'], default='cli', help='run the docker CLI or talk to the Docker Engine API')
+        sub.add_argument('--socket', default='/var/run/docker.sock', help='Docker Engine API unix socket of the engine backend')
+        sub.add_argument('-H', '--docker-host', action='append', metavar='HOST',
+            help='docker host to build on, repeat to spread builds over several hosts')
+        sub.add_argument('--trace', metavar='FILE', help='write timings as a Chrome trace event file')
+
+    for sub in [parser_build, parser_push]:
+        sub.add_argument('--cache-from', action="store_true",
+            help="pull each image's previous build, previous version and parent to use them as build cache")
+        sub.add_argument('--cache-dir', metavar='DIR',
+            help="load build cache images from DIR and save built images to it, to keep the cache between runs")
+
+    for sub in [parser_generate, parser_build, parser_push, parser_plan]:
+        sub.add_argument('--context', choices=['copy', 'link', 'tar'], default='copy',
+            help='copy or hard link support files into build directories, or stream them into the build context as a tar')
+        sub.add_argument('--changed-since', metavar='REF', help='only images affected by files changed since git ref')
+        sub.add_argument('--changed', metavar='PATH', nargs='+', help='only images affected by changed files')
+        sub.add_argument('--flatten', action="store_true",
+            help='render every leaf image and its ancestors as one multi-stage Dockerfile')
     parsed = parser.parse_args()
 
     project = Project()
@@ -511,4 +2318,7 @@ if __name__ == "__main__":
         project.make_plan(parsed)
         project.take_action()
     except RuntimeError as e:
-        self.logger.error("%s" % e)
+        project.logger.error("%s" % e)
+    finally:
+        if parsed.trace != None:
+            project.tracer.write(parsed.trace)
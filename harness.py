@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import shutil
+import tarfile
+import tempfile
+import argparse
+import threading
+import traceback
+import urlparse
+import SocketServer
+import BaseHTTPServer
+from StringIO import StringIO
+
+import dib
+
+class FakeEngineHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Answers the Docker Engine API requests of DockerEngine's build and push
+    with JSON progress streams, images whose name contains "broken" fail
+    with an error message in the stream
+    '''
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def address_string(self):
+        return "unix"
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding") == "chunked":
+            body = ""
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def send_stream(self, messages):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for message in messages:
+            data = json.dumps(message) + "\r\n"
+            self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.write("0\r\n\r\n")
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        body = self.read_body()
+        self.server.requests.append((self.command, url.path, query, dict(self.headers), body))
+        if url.path == "/v1.25/build":
+            name = query["t"]
+            if "broken" in name:
+                self.send_stream([{"stream": "Step 1/2 : FROM scratch\n"},
+                    {"errorDetail": {"message": "boom"}, "error": "boom"}])
+            else:
+                self.send_stream([{"stream": "Step 1/2 : FROM scratch\n"},
+                    {"stream": "Step 2/2 : ADD file.txt /\n"}, {"stream": " ---> Using cache\n"},
+                    {"stream": "Successfully tagged %s\n" % name}])
+        elif url.path.startswith("/v1.25/images/") and url.path.endswith("/push"):
+            if "broken" in url.path:
+                self.send_stream([{"status": "The push refers to repository"},
+                    {"errorDetail": {"message": "denied"}, "error": "denied"}])
+            else:
+                self.send_stream([{"status": "The push refers to repository"},
+                    {"id": "1234", "status": "Pushed"}, {"status": "%s: digest: sha256:abc" % query["tag"]}])
+        else:
+            self.send_error(404)
+
+class FakeEngine(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    '''
+    Docker Engine on a unix socket, records the requests it gets as
+    (method, path, query, headers, body) tuples
+    '''
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        SocketServer.UnixStreamServer.__init__(self, socket_path, FakeEngineHandler)
+        self.requests = []
+
+class FakeRegistryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Answers manifest HEAD requests: 200 with a digest for the manifests it
+    has, 401 for repositories starting with "private", 404 otherwise
+    '''
+    manifests = {("dib/app", "1.0"): "sha256:0123456789abcdef"}
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        parts = self.path.split("/manifests/")
+        repository, tag = parts[0][len("/v2/"):], parts[1]
+        self.server.requests.append((self.command, self.path, dict(self.headers)))
+        if repository.startswith("private"):
+            self.send_response(401)
+            self.send_header("WWW-Authenticate", 'Bearer realm="https://auth.example.com/token"')
+        elif self.manifests.has_key((repository, tag)):
+            self.send_response(200)
+            self.send_header("Docker-Content-Digest", self.manifests[(repository, tag)])
+        else:
+            self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+class FakeRegistryServer(BaseHTTPServer.HTTPServer):
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), FakeRegistryHandler)
+        self.requests = []
+
+def serve(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def expect_error(action, text):
+    try:
+        action()
+    except RuntimeError as e:
+        assert text in str(e), "error %r does not tell %r" % (str(e), text)
+        return
+    raise AssertionError("no RuntimeError raised")
+
+def check_engine_build(engine, server, work_dir):
+    context_dir = os.path.join(work_dir, "context")
+    os.makedirs(context_dir)
+    with open(os.path.join(context_dir, "Dockerfile"), "w") as f:
+        f.write("FROM scratch\nADD file.txt /\n")
+    with open(os.path.join(work_dir, "file.txt"), "w") as f:
+        f.write("support file\n")
+    context = dib.BuildContext(context_dir, [(os.path.join(work_dir, "file.txt"), "file.txt")])
+
+    log = StringIO()
+    engine.build_image("localhost:5000/dib/app", "1.0", context, log, ["localhost:5000/dib/app:0.9"], True)
+    method, path, query, headers, body = server.requests[-1]
+    assert (method, path) == ("POST", "/v1.25/build"), (method, path)
+    assert query["t"] == "localhost:5000/dib/app:1.0", query
+    assert json.loads(query["cachefrom"]) == ["localhost:5000/dib/app:0.9"], query
+    assert json.loads(query["buildargs"]) == {"BUILDKIT_INLINE_CACHE": "1"}, query
+    names = tarfile.open(fileobj=StringIO(body)).getnames()
+    assert "./Dockerfile" in names and "file.txt" in names, names
+    assert log.getvalue() == ("Step 1/2 : FROM scratch\nStep 2/2 : ADD file.txt /\n ---> Using cache\n"
+        "Successfully tagged localhost:5000/dib/app:1.0\n"), log.getvalue()
+    assert engine.cached_image("localhost:5000/dib/app", "1.0")
+
+    log = StringIO()
+    expect_error(lambda: engine.build_image("localhost:5000/dib/broken", "1.0", context, log), "boom")
+    assert log.getvalue() == "Step 1/2 : FROM scratch\n", log.getvalue()
+    assert not engine.cached_image("localhost:5000/dib/broken", "1.0")
+
+def check_engine_push(engine, server, work_dir):
+    log = StringIO()
+    engine.push_image("localhost:5000/dib/app", "1.0", log)
+    method, path, query, headers, body = server.requests[-1]
+    assert (method, path) == ("POST", "/v1.25/images/localhost:5000/dib/app/push"), (method, path)
+    assert query == {"tag": "1.0"}, query
+    assert headers.has_key("x-registry-auth"), headers
+    assert log.getvalue() == " The push refers to repository\n1234 Pushed\n 1.0: digest: sha256:abc\n", log.getvalue()
+
+    expect_error(lambda: engine.push_image("localhost:5000/dib/broken", "1.0", StringIO()), "denied")
+
+def check_registry(registry, server):
+    assert registry.manifest_digest("dib/app", "1.0") == "sha256:0123456789abcdef"
+    method, path, headers = server.requests[-1]
+    assert (method, path) == ("HEAD", "/v2/dib/app/manifests/1.0"), (method, path)
+    assert "application/vnd.docker.distribution.manifest.v2+json" in headers["accept"], headers
+
+    assert registry.manifest_digest("dib/app", "2.0") == None
+    expect_error(lambda: registry.manifest_digest("private/app", "1.0"), "returns 401")
+
+if __name__ == "__main__":
+    """
+    python harness.py
+    Runs dib's Docker Engine API and registry clients against fake servers,
+    a Docker Engine on a unix socket and a registry on a local port
+    """
+    parser = argparse.ArgumentParser()
+    parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="dib-harness-")
+    engine_server = serve(FakeEngine(os.path.join(work_dir, "docker.sock")))
+    registry_server = serve(FakeRegistryServer())
+    engine = dib.DockerEngine("unix://" + os.path.join(work_dir, "docker.sock"))
+    registry = dib.Registry("127.0.0.1:%i" % registry_server.server_address[1])
+
+    checks = [("engine build", lambda: check_engine_build(engine, engine_server, work_dir)),
+        ("engine push", lambda: check_engine_push(engine, engine_server, work_dir)),
+        ("registry manifest", lambda: check_registry(registry, registry_server))]
+    failed = 0
+    try:
+        for name, check in checks:
+            try:
+                check()
+                print "OK   %s" % name
+            except Exception:
+                failed += 1
+                print "FAIL %s" % name
+                traceback.print_exc()
+    finally:
+        engine_server.shutdown()
+        registry_server.shutdown()
+        shutil.rmtree(work_dir)
+    sys.exit(1 if failed > 0 else 0)